@@ -1,38 +1,131 @@
 import numpy as np
-from collections import defaultdict, deque
+import os
+from collections import defaultdict, deque, namedtuple
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier, GradientBoostingClassifier
+from sklearn.linear_model import SGDClassifier
 from sklearn.preprocessing import StandardScaler
-from scipy.fft import fft
 from colorama import Fore, Style
 import time
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import threading
+import logging
+from predictor_registry import deep_sizeof, model_sizeof
+from rolling_stats import RollingAccuracy
+from sequence_buffer import SequenceBuffer
+from serial_queue import SerialQueue
+from chunked_training import ChunkedTrainingData
+from cycle_detector import CycleDetector
+from ensemble_table import EnsembleTable
+from feature_engine import BatchFeatureExtractor
+from pattern_store import PatternTable, decode_pattern, to_bits, window_codes
+
+
+DEFAULT_REFIT_INTERVAL = 500
+
+# Read-only view of a predictor, republished after every update. Readers never
+# take the update queue, so they see a consistent state without blocking it.
+PredictorSnapshot = namedtuple('PredictorSnapshot', [
+    'version', 'prediction_state', 'last_prediction', 'last_char', 'consecutive_errors', 'prediction_count',
+    'chars_seen', 'sequence_length', 'method_performance', 'ensemble_weights', 'published_at'])
+
+
+class BatchPredictionError(Exception):
+    # A character of predict_batch failed; the ones before it were applied
+    def __init__(self, index, predictions, error):
+        super().__init__(str(error))
+        self.index = index
+        self.predictions = predictions
 
 
 class EnhancedGamePredictor:
-    def __init__(self, sequence):
-        # Initialize with a custom sequence passed from the main code
-        self.sequence = sequence
-        self.current_sequence = self.sequence
-        self.current_sequence = self.sequence
-        self.pattern_memory = defaultdict(lambda: {'A': 0, 'B': 0})
+    # State updated on every character, saved in session journal snapshots next to
+    # the batch models and time patterns, see session_state
+    SESSION_ATTRIBUTES = ('current_sequence', 'cycle_detector', 'pattern_database', 'ngram_patterns',
+                          'online_classifier', 'ensemble_weights', 'method_performance', 'pattern_success_rate',
+                          'transition_probs', 'char_counts', 'chars_seen', 'prediction_history',
+                          'accuracy_history', 'recent_predictions', 'recent_method_accuracy', 'prediction_count',
+                          'prediction_state', 'consecutive_errors', 'background_analysis_active',
+                          'last_prediction', 'last_confidence', 'last_user_input', 'pending_features',
+                          'chars_since_refit')
+
+    # Phases of initialize_components, in order
+    TRAINING_PHASES = ('build_pattern_database', 'prepare_training_data', 'scale_features',
+                       'fit_random_forest', 'fit_gradient_boosting', 'compile_ensemble_table',
+                       'initialize_bayesian_priors')
+
+    def __init__(self, sequence, max_sequence_length=10000, cycle_window=512, initialize=True,
+                 progress_callback=None, history_limit=1000, parallel_training=None, n_jobs=None,
+                 online_learning=None, refit_interval=None, chunked_training=None, compile_ensemble=None):
+        # Initialize with a custom sequence passed from the main code, held as bits
+        self.sequence = SequenceBuffer.fixed(sequence)
+        # Parallel training runs independent stages concurrently and fits the forest on n_jobs cores
+        if parallel_training is None:
+            parallel_training = os.environ.get('PREDICTOR_PARALLEL_TRAINING', '').lower() in ('1', 'true', 'yes')
+        if n_jobs is None:
+            n_jobs = int(os.environ.get('PREDICTOR_TRAINING_JOBS', os.cpu_count() or 1))
+        self.parallel_training = parallel_training
+        self.n_jobs = max(1, n_jobs)
+        # Online learning adds an SGD model to the ensemble that learns from every verified
+        # character; the batch models are refit in the background every refit_interval characters
+        if online_learning is None:
+            online_learning = os.environ.get('PREDICTOR_ONLINE_LEARNING', '').lower() in ('1', 'true', 'yes')
+        if refit_interval is None:
+            refit_interval = int(os.environ.get('PREDICTOR_REFIT_INTERVAL', DEFAULT_REFIT_INTERVAL))
+        self.online_learning = online_learning
+        self.refit_interval = refit_interval
+        # Out-of-core training for long histories: a ChunkedTrainingData that samples
+        # windows and builds the training matrix on disk, or None for the in-memory path
+        if chunked_training is None and os.environ.get('PREDICTOR_CHUNKED_TRAINING', '').lower() in ('1', 'true', 'yes'):
+            chunked_training = ChunkedTrainingData()
+        self.chunked_training = chunked_training or None
+        # Score the batch models on every possible input after training, see EnsembleTable
+        if compile_ensemble is None:
+            compile_ensemble = os.environ.get('PREDICTOR_COMPILE_ENSEMBLE', '1').lower() in ('1', 'true', 'yes')
+        self.compile_ensemble = compile_ensemble
+        # Called as progress_callback(phase, seconds) after each training phase
+        self.progress_callback = progress_callback
+        # Optional observer(method_name, seconds) for per-call timings, see timed()
+        self.observer = None
+        self.phase_timings = {}
+        self.max_sequence_length = max_sequence_length
+        self.cycle_window = cycle_window
+        self.history_limit = history_limit
+        # Live sequence is a bounded rolling buffer of the most recent characters
+        self.current_sequence = SequenceBuffer(self.sequence, capacity=max_sequence_length)
+        self.cycle_detector = CycleDetector(window=cycle_window)
+        self.cycle_detector.extend(self.current_sequence.bits(cycle_window))
         self.max_pattern_length = 13
         self.min_pattern_length = 5
-        self.prediction_history = []
-        self.accuracy_history = []
+        # Histories are ring buffers capped at history_limit entries
+        self.prediction_history = deque(maxlen=history_limit)
+        self.accuracy_history = deque(maxlen=history_limit)
+        self.prediction_count = 0
+        self.chars_seen = len(self.sequence)
         self.window_size = 20
-        self.recent_predictions = deque(maxlen=self.window_size)
-        self.pattern_success_rate = {}
+        self.recent_predictions = RollingAccuracy(self.window_size)
+        self.recent_weight_window = 50
+        self.recent_method_accuracy = RollingAccuracy(self.recent_weight_window)
+        # [correct, total] per min_pattern_length pattern, indexed by its encoding
+        self.pattern_success_rate = np.zeros((1 << self.min_pattern_length, 2), dtype=np.int32)
 
+        self.feature_extractor = BatchFeatureExtractor(self.max_pattern_length)
         self.scaler = StandardScaler()
         self.rf_classifier = RandomForestClassifier(n_estimators=100)
         self.gb_classifier = GradientBoostingClassifier()
         self.ensemble_weights = {'rf': 0.5, 'gb': 0.5}
-
-        # Pattern cache
-        self.pattern_cache = {}
-        self.prediction_cache = {}
+        self.online_classifier = None
+        self.ensemble_table = None
+        # Incremented whenever the batch models are replaced
+        self.model_generation = 0
+        if self.online_learning:
+            self.online_classifier = SGDClassifier(loss='log_loss')
+            self.ensemble_weights = {'rf': 1 / 3, 'gb': 1 / 3, 'online': 1 / 3}
+        # Unscaled features of the window behind the last ensemble prediction
+        self.pending_features = None
+        self.chars_since_refit = 0
 
         # Time patterns
         self.time_patterns = defaultdict(lambda: {'A': 0, 'B': 0})
@@ -51,39 +144,261 @@ class EnhancedGamePredictor:
         self.consecutive_errors = 0
         self.error_threshold = 3
         self.confidence_threshold = 0.75
-        self.reanalysis_lock = threading.Lock()
         self.background_analysis_active = False
         self.last_prediction = None
         self.last_confidence = 0
         self.last_user_input = None
 
-        # Initialize components
-        self.initialize_components()
+        # Every state change runs on this queue, one at a time and in order; background
+        # reanalysis works on copies and queues its results like any other update
+        self.updates = SerialQueue()
+        self.snapshot = None
+        # Called with every new snapshot on the thread that published it, see add_listener
+        self.listeners = ()
+        self.listener_lock = threading.Lock()
+        # SessionJournal notified of every update, see session_journal.py. While a
+        # journal is replayed, no background work is started and hours are pinned.
+        self.journal = None
+        self.replaying = False
+        self.replay_hour = None
+
+        # Initialize components (skipped when restoring a trained state instead)
+        if initialize:
+            self.initialize_components()
+        self.publish_snapshot()
 
     def initialize_components(self):
-        self.build_pattern_database()
-        self.initialize_ensemble_models()
-        self.initialize_bayesian_priors()
+        if self.parallel_training:
+            self.initialize_components_parallel()
+        else:
+            with self.training_phase('build_pattern_database'):
+                self.build_pattern_database()
+            X_scaled, y = self.initialize_ensemble_models()
+            if self.online_learning:
+                with self.training_phase('fit_online_model'):
+                    self.fit_online_model(self.online_classifier, X_scaled, y)
+            with self.training_phase('compile_ensemble_table'):
+                self.ensemble_table = self.compile_ensemble_table(self.scaler, self.rf_classifier,
+                                                                  self.gb_classifier)
+            with self.training_phase('initialize_bayesian_priors'):
+                self.initialize_bayesian_priors()
         self.executor = ThreadPoolExecutor(max_workers=4)
 
-    def build_pattern_database(self):
-        self.pattern_database = defaultdict(lambda: {'A': 0, 'B': 0})
-        self.ngram_patterns = defaultdict(lambda: {'A': 0, 'B': 0})
-
-        for length in range(self.min_pattern_length, self.max_pattern_length + 1):
-            for i in range(len(self.sequence) - length):
-                pattern = self.sequence[i:i + length]
-                next_char = self.sequence[i + length]
+    def initialize_components_parallel(self):
+        # Same phases as the serial path. The pattern tables and priors only depend
+        # on the sequence, so they are built while the training matrix is prepared;
+        # then both classifiers are fitted at the same time.
+        def run_phase(phase, method, *args):
+            with self.training_phase(phase):
+                return method(*args)
+
+        with ThreadPoolExecutor(max_workers=3) as stages:
+            patterns = stages.submit(run_phase, 'build_pattern_database', self.build_pattern_database)
+            priors = stages.submit(run_phase, 'initialize_bayesian_priors', self.initialize_bayesian_priors)
+
+            X, y = run_phase('prepare_training_data', self.prepare_training_data)
+            X_scaled = run_phase('scale_features', self.scale_training_data, self.scaler, X)
+
+            forest = stages.submit(run_phase, 'fit_random_forest', self.fit_random_forest, X_scaled, y)
+            run_phase('fit_gradient_boosting', self.gb_classifier.fit, X_scaled, y)
+            if self.online_learning:
+                run_phase('fit_online_model', self.fit_online_model, self.online_classifier, X_scaled, y)
+
+            forest.result()
+            self.ensemble_table = run_phase('compile_ensemble_table', self.compile_ensemble_table,
+                                            self.scaler, self.rf_classifier, self.gb_classifier)
+            for future in (patterns, priors):
+                future.result()
+
+    def fit_random_forest(self, X, y):
+        # Trees are built on n_jobs threads; prediction stays single-threaded, where
+        # joblib dispatch would cost more than scoring a handful of rows
+        self.rf_classifier.set_params(n_jobs=self.n_jobs if self.parallel_training else None)
+        try:
+            self.rf_classifier.fit(X, y)
+        finally:
+            self.rf_classifier.set_params(n_jobs=None)
+
+    def compile_ensemble_table(self, scaler, rf_classifier, gb_classifier):
+        if not self.compile_ensemble:
+            return None
+        return EnsembleTable.compile(self.feature_extractor, scaler, {'rf': rf_classifier, 'gb': gb_classifier})
+
+    def load_ensemble_table(self, probabilities):
+        # States saved before tables were compiled, or with compiling off, are compiled here
+        if not self.compile_ensemble:
+            self.ensemble_table = None
+        elif probabilities is not None:
+            self.ensemble_table = EnsembleTable(('rf', 'gb'), probabilities)
+        else:
+            self.ensemble_table = self.compile_ensemble_table(self.scaler, self.rf_classifier, self.gb_classifier)
+
+    def fit_online_model(self, model, X, y):
+        # One pass over the training rows, so the model starts where the batch models do.
+        # Chunked training feeds it a chunk at a time, converted to the float64 rows it
+        # is later updated with, rather than copying all of X.
+        rows = len(X) if self.chunked_training is None else self.chunked_training.chunk_rows
+        for start in range(0, max(len(X), 1), max(rows, 1)):
+            X_chunk = np.asarray(X[start:start + rows], dtype=np.float64)
+            model.partial_fit(X_chunk, y[start:start + rows], classes=np.array([0, 1]))
+        return model
+
+    def timed(self, name, method, *args):
+        if self.observer is None:
+            return method(*args)
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.observer(name, time.perf_counter() - start)
+
+    @contextmanager
+    def training_phase(self, phase):
+        start = time.perf_counter()
+        yield
+        self.phase_timings[phase] = time.perf_counter() - start
+        if self.progress_callback is not None:
+            self.progress_callback(phase, self.phase_timings[phase])
+
+    def hyperparameters(self):
+        # Everything besides the sequence that affects what initialize_components produces
+        params = {
+            'min_pattern_length': self.min_pattern_length,
+            'max_pattern_length': self.max_pattern_length,
+            'max_sequence_length': self.max_sequence_length,
+            'cycle_window': self.cycle_window,
+            'rf': {k: v for k, v in self.rf_classifier.get_params().items() if k != 'n_jobs'},
+            'gb': self.gb_classifier.get_params()
+        }
+        if self.online_learning:
+            params['online'] = self.online_classifier.get_params()
+        if self.chunked_training is not None:
+            params['chunked_training'] = self.chunked_training.params()
+        return params
+
+    def trained_state(self):
+        # Output of initialize_components as (count arrays, picklable objects)
+        arrays = {f'pattern_{length}': table for length, table in self.pattern_database.counts.items()}
+        arrays.update({f'ngram_{length}': table for length, table in self.ngram_patterns.counts.items()})
+        if self.ensemble_table is not None:
+            arrays['ensemble_table'] = self.ensemble_table.probabilities
+        objects = {
+            'scaler': self.scaler,
+            'rf_classifier': self.rf_classifier,
+            'gb_classifier': self.gb_classifier,
+            'online_classifier': self.online_classifier,
+            'ensemble_weights': self.ensemble_weights,
+            'transition_probs': self.transition_probs,
+            'char_counts': self.char_counts,
+            'chars_seen': self.chars_seen,
+            'time_patterns': dict(self.time_patterns)
+        }
+        return arrays, objects
+
+    def restore_components(self, arrays, objects):
+        # Counterpart of initialize_components for a state saved by trained_state
+        self.pattern_database = PatternTable(self.min_pattern_length, self.max_pattern_length)
+        self.pattern_database.counts = {length: arrays[f'pattern_{length}']
+                                        for length in self.pattern_database.counts}
+        self.ngram_patterns = PatternTable(2, 4)
+        self.ngram_patterns.counts = {length: arrays[f'ngram_{length}']
+                                      for length in self.ngram_patterns.counts}
+
+        self.scaler = objects['scaler']
+        self.rf_classifier = objects['rf_classifier']
+        self.gb_classifier = objects['gb_classifier']
+        self.online_classifier = objects.get('online_classifier')
+        self.load_ensemble_table(arrays.get('ensemble_table'))
+        self.ensemble_weights = dict(objects['ensemble_weights'])
+        self.transition_probs = {char: dict(counts) for char, counts in objects['transition_probs'].items()}
+        self.char_counts = dict(objects['char_counts'])
+        self.chars_seen = objects['chars_seen']
+        self.time_patterns.update({hour: dict(counts) for hour, counts in objects['time_patterns'].items()})
+        self.update_bayesian_priors()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.publish_snapshot()
+
+    def session_config(self):
+        # Constructor arguments a recovered session is created with
+        return {
+            'max_sequence_length': self.max_sequence_length,
+            'cycle_window': self.cycle_window,
+            'history_limit': self.history_limit,
+            'online_learning': self.online_learning,
+            'refit_interval': self.refit_interval,
+            'compile_ensemble': self.compile_ensemble
+        }
 
-                self.pattern_database[pattern][next_char] += 1
-                self.pattern_cache[pattern] = {
-                    'frequency': self.pattern_database[pattern],
-                    'timestamp': time.time()
-                }
+    def session_state(self):
+        # (models, state) for a journal snapshot. The models only change with a refit,
+        # see model_generation; the state changes with every character.
+        models = {
+            'sequence': self.sequence.bits(),
+            'scaler': self.scaler,
+            'rf_classifier': self.rf_classifier,
+            'gb_classifier': self.gb_classifier,
+            'ensemble_table': self.ensemble_table.probabilities if self.ensemble_table is not None else None
+        }
+        state = {name: getattr(self, name) for name in self.SESSION_ATTRIBUTES}
+        state['time_patterns'] = dict(self.time_patterns)
+        return models, state
+
+    def restore_session(self, models, state):
+        # Counterpart of session_state, on a predictor created with initialize=False
+        self.sequence = SequenceBuffer.fixed(models['sequence'])
+        self.scaler = models['scaler']
+        self.rf_classifier = models['rf_classifier']
+        self.gb_classifier = models['gb_classifier']
+        self.load_ensemble_table(models['ensemble_table'])
+        for name in self.SESSION_ATTRIBUTES:
+            setattr(self, name, state[name])
+        self.time_patterns.update(state['time_patterns'])
+        self.update_bayesian_priors()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.publish_snapshot()
+
+    def replay(self, records):
+        # Applies journal records on top of restore_session. Returns how many replayed
+        # predictions differ from the journaled ones, which should be none.
+        mismatches = 0
+        self.replaying = True
+        try:
+            for record in records:
+                if record.kind == 'prediction':
+                    self.replay_hour = record.hour
+                    mismatches += self.advance(record.char)[0] != record.predicted
+                else:
+                    self.publish_reanalysis({'analyze_errors': record.analyze_errors, 'refit': None,
+                                             'ensemble_weights': record.ensemble_weights})
+        finally:
+            self.replaying = False
+            self.replay_hour = None
+        self.publish_snapshot()
+        return mismatches
+
+    def resume_background_work(self):
+        # A reanalysis that had not published its result before the journal ended runs again
+        if self.background_analysis_active:
+            self.updates.call(self.run_update, self.start_reanalysis, self.prediction_state == 'WAITING')
+
+    def current_hour(self):
+        return datetime.now().hour if self.replay_hour is None else self.replay_hour
 
-                for n in range(2, min(length, 5)):
-                    ngram = pattern[-n:]
-                    self.ngram_patterns[ngram][next_char] += 1
+    def build_pattern_database(self):
+        self.pattern_database = PatternTable(self.min_pattern_length, self.max_pattern_length)
+        self.ngram_patterns = PatternTable(2, 4)
+        if self.parallel_training and self.n_jobs > 1:
+            # Split by sequence chunk and merge the per-chunk counts
+            with ThreadPoolExecutor(max_workers=self.n_jobs) as pool:
+                self.pattern_database.build(self.sequence, executor=pool, chunks=self.n_jobs)
+                self.ngram_patterns.build(self.sequence, executor=pool, chunks=self.n_jobs)
+        elif self.chunked_training is not None:
+            chunk_size = self.chunked_training.chunk_rows
+            self.pattern_database.build(self.sequence, chunk_size=chunk_size)
+            self.ngram_patterns.build(self.sequence, chunk_size=chunk_size)
+        else:
+            self.pattern_database.build(self.sequence)
+            self.ngram_patterns.build(self.sequence)
 
         current_hour = datetime.now().hour
         self.time_patterns[current_hour] = {
@@ -92,24 +407,37 @@ class EnhancedGamePredictor:
         }
 
     def initialize_ensemble_models(self):
-        X, y = self.prepare_training_data()
-        X_scaled = self.scaler.fit_transform(X)
-        self.rf_classifier.fit(X_scaled, y)
-        self.gb_classifier.fit(X_scaled, y)
+        with self.training_phase('prepare_training_data'):
+            X, y = self.prepare_training_data()
+        with self.training_phase('scale_features'):
+            X_scaled = self.scale_training_data(self.scaler, X)
+        with self.training_phase('fit_random_forest'):
+            self.fit_random_forest(X_scaled, y)
+        with self.training_phase('fit_gradient_boosting'):
+            self.gb_classifier.fit(X_scaled, y)
+        return X_scaled, y
 
     def initialize_bayesian_priors(self):
+        self.char_counts = {'A': self.sequence.count('A'), 'B': self.sequence.count('B')}
+        self.chars_seen = len(self.sequence)
+        self.update_bayesian_priors()
+        self.transition_probs = self.calculate_transition_probabilities()
+
+    def update_bayesian_priors(self):
         self.bayesian_priors = {
-            'A': len([c for c in self.sequence if c == 'A']) / len(self.sequence),
-            'B': len([c for c in self.sequence if c == 'B']) / len(self.sequence)
+            'A': self.char_counts['A'] / self.chars_seen,
+            'B': self.char_counts['B'] / self.chars_seen
         }
-        self.transition_probs = self.calculate_transition_probabilities()
 
     def calculate_transition_probabilities(self):
-        transitions = {'A': {'A': 0, 'B': 0}, 'B': {'A': 0, 'B': 0}}
-        for i in range(len(self.sequence) - 1):
-            curr, next_char = self.sequence[i], self.sequence[i + 1]
-            transitions[curr][next_char] += 1
-        return transitions
+        # Pairs by current and next character, with A = 1; only AA needs a pass of its own
+        bits = self.sequence.bits()
+        pairs = max(len(bits) - 1, 0)
+        aa = int(np.count_nonzero(bits[:-1] & bits[1:]))
+        ab = int(np.count_nonzero(bits[:-1])) - aa
+        ba = int(np.count_nonzero(bits[1:])) - aa
+        bb = pairs - aa - ab - ba
+        return {'A': {'A': aa, 'B': ab}, 'B': {'A': ba, 'B': bb}}
 
     def attempt_resume_prediction(self):
         if self.prediction_state == 'WAITING':
@@ -118,60 +446,33 @@ class EnhancedGamePredictor:
                 self.prediction_state = 'PREDICTING'
 
     def calculate_current_confidence(self):
-        recent_predictions = self.prediction_history[-20:]
-        if not recent_predictions:
+        if not len(self.recent_predictions):
             return 0.5
-
-        correct_count = sum(1 for pred in recent_predictions if pred.get('correct', False))
-        confidence = correct_count / len(recent_predictions)
-        return confidence
-
-    def prepare_training_data(self):
-        X = []
-        y = []
-        augmented_data = self.augment_training_data()
-
-        for i in range(len(augmented_data) - self.max_pattern_length):
-            features = self.extract_features(augmented_data[i:i + self.max_pattern_length])
-            X.append(features)
-            y.append(1 if augmented_data[i + self.max_pattern_length] == 'A' else 0)
-
-        return np.array(X), np.array(y)
-
-    def augment_training_data(self):
-        augmented = self.sequence
-        augmented += self.sequence[::-1]  # Add reversed sequence
-        augmented += ''.join('A' if c == 'B' else 'B' for c in self.sequence)  # Add inverted sequence
+        return self.recent_predictions.accuracy()
+
+    def prepare_training_data(self, sequence=None):
+        # One BatchFeatureExtractor row per window of the augmented sequence
+        if self.chunked_training is not None:
+            bits = (self.sequence if sequence is None else sequence).bits()
+            return self.chunked_training.training_data(self.feature_extractor, bits, datetime.now().hour)
+        augmented_data = self.augment_training_data(sequence)
+        return self.feature_extractor.training_data(augmented_data, datetime.now().hour)
+
+    def augment_training_data(self, sequence=None):
+        # Sequence, reversed sequence and inverted sequence as one bit array
+        sequence = self.sequence if sequence is None else sequence
+        bits = sequence.bits()
+        n = len(bits)
+        augmented = np.empty(3 * n, dtype=np.uint8)
+        augmented[:n] = bits
+        augmented[n:2 * n] = sequence.reversed()
+        np.subtract(1, bits, out=augmented[2 * n:])
         return augmented
 
-    def extract_features(self, pattern):
-        features = []
-        features.extend([1 if c == 'A' else 0 for c in pattern])
-        features.append(pattern.count('A') / len(pattern))
-        features.append(self.calculate_entropy(pattern))
-
-        current_hour = datetime.now().hour
-        features.append(np.sin(2 * np.pi * current_hour / 24))
-        features.append(np.cos(2 * np.pi * current_hour / 24))
-
-        complexity = self.analyze_pattern_complexity(pattern)
-        features.append(complexity)
-
-        return features
-
-    def calculate_entropy(self, pattern):
-        freq_a = pattern.count('A') / len(pattern)
-        freq_b = 1 - freq_a
-        if freq_a == 0 or freq_b == 0:
-            return 0
-        return -(freq_a * np.log2(freq_a) + freq_b * np.log2(freq_b))
-
-    def analyze_pattern_complexity(self, pattern):
-        entropy = self.calculate_entropy(pattern)
-        repetition_score = len(set(pattern)) / len(pattern)
-        transition_count = sum(1 for i in range(len(pattern) - 1) if pattern[i] != pattern[i + 1])
-        transition_score = transition_count / (len(pattern) - 1) if len(pattern) > 1 else 0
-        return np.mean([entropy, repetition_score, transition_score])
+    def scale_training_data(self, scaler, X):
+        if self.chunked_training is not None:
+            return self.chunked_training.fit_transform(scaler, X)
+        return scaler.fit_transform(X)
 
     def combine_predictions(self, predictions, weights):
         weighted_votes = defaultdict(float)
@@ -183,15 +484,36 @@ class EnhancedGamePredictor:
 
         return (final_pred[0], final_pred[1], best_method)
 
-    def get_ensemble_prediction(self):
-        features = self.extract_features(self.current_sequence[-self.max_pattern_length:])
-        X = self.scaler.transform([features])
+    def get_ensemble_prediction(self, model_probs=None):
+        # model_probs: precomputed (rf_prob, gb_prob) for the current window, see batch_model_probabilities
+        # The online model changes after every character, so it is never batch scored
+        table = self.ensemble_table
+        if model_probs is None and table is not None and len(self.current_sequence) >= self.max_pattern_length:
+            hour = self.current_hour()
+            code = self.current_sequence.tail_code(self.max_pattern_length)
+            if not self.online_learning:
+                ensemble_prob = table.lookup(hour, code, self.ensemble_weights)
+                return 'A' if ensemble_prob[1] > 0.5 else 'B', max(ensemble_prob)
+            model_probs = table.model_probs(hour, code)
+
+        X = None
+        if model_probs is None or self.online_learning:
+            features = self.feature_extractor.transform_buffer(self.current_sequence, self.current_hour())
+            X = self.scaler.transform(features)
+
+        if model_probs is None:
+            rf_prob = self.rf_classifier.predict_proba(X)[0]
+            gb_prob = self.gb_classifier.predict_proba(X)[0]
+        else:
+            rf_prob, gb_prob = model_probs
 
-        rf_prob = self.rf_classifier.predict_proba(X)[0]
-        gb_prob = self.gb_classifier.predict_proba(X)[0]
+        probs = {'rf': rf_prob, 'gb': gb_prob}
+        if self.online_learning:
+            probs['online'] = self.online_classifier.predict_proba(X)[0]
+            self.pending_features = features
 
-        ensemble_prob = (rf_prob * self.ensemble_weights['rf'] +
-                         gb_prob * self.ensemble_weights['gb'])
+        total_weight = sum(self.ensemble_weights[model] for model in probs)
+        ensemble_prob = sum(prob * self.ensemble_weights[model] for model, prob in probs.items()) / total_weight
 
         return 'A' if ensemble_prob[1] > 0.5 else 'B', max(ensemble_prob)
 
@@ -213,14 +535,14 @@ class EnhancedGamePredictor:
         if len(self.current_sequence) < self.min_pattern_length:
             return 'A', 0.5
 
-        recent_pattern = self.current_sequence[-self.max_pattern_length:]
-        pattern_probs = self.pattern_database[recent_pattern]
-        total = sum(pattern_probs.values())
+        length = min(len(self.current_sequence), self.max_pattern_length)
+        pattern_counts = self.pattern_database.get_code(length, self.current_sequence.tail_code(length))
+        total = int(pattern_counts.sum())
 
         if total == 0:
             return 'A', 0.5
 
-        prob_a = pattern_probs['A'] / total
+        prob_a = pattern_counts[0] / total
         return 'A' if prob_a > 0.5 else 'B', max(prob_a, 1 - prob_a)
 
     def get_bayesian_prediction(self):
@@ -241,26 +563,22 @@ class EnhancedGamePredictor:
         return 'A' if normalized_prob_a > 0.5 else 'B', max(normalized_prob_a, 1 - normalized_prob_a)
 
     def get_cycle_prediction(self):
-        if len(self.current_sequence) < 10:
+        if len(self.cycle_detector) < 10:
             return 'A', 0.5
 
-        numeric_sequence = np.array([1 if c == 'A' else 0 for c in self.current_sequence])
-        fft_result = np.abs(fft(numeric_sequence))
-        dominant_freq = np.argmax(fft_result[1:len(fft_result) // 2]) + 1
-
-        if dominant_freq == 0:
-            return 'A', 0.5
-
-        cycle_length = len(numeric_sequence) // dominant_freq
+        # Dominant period over the last cycle_window characters
+        cycle_length, _ = self.cycle_detector.dominant_period()
         if cycle_length == 0:
             return 'A', 0.5
 
-        predicted_value = numeric_sequence[-cycle_length]
+        predicted_value = self.cycle_detector.value_at(cycle_length)
         return 'A' if predicted_value > 0.5 else 'B', abs(predicted_value - 0.5) * 2
 
     def verify_prediction(self, prediction, actual):
         is_correct = prediction[0] == actual
         self.update_verification_metrics(prediction, actual, is_correct)
+        if self.online_learning:
+            self.timed('learn_online', self.learn_online, actual)
 
         if is_correct:
             self.consecutive_errors = 0
@@ -277,53 +595,237 @@ class EnhancedGamePredictor:
         if is_correct:
             self.method_performance[method]['correct'] += 1
 
-        pattern = self.current_sequence[-self.min_pattern_length:]
-        if pattern not in self.pattern_success_rate:
-            self.pattern_success_rate[pattern] = {'correct': 0, 'total': 0}
-        self.pattern_success_rate[pattern]['total'] += 1
-        if is_correct:
-            self.pattern_success_rate[pattern]['correct'] += 1
+        if self.prediction_history:
+            self.prediction_history[-1]['correct'] = is_correct
+        self.accuracy_history.append(is_correct)
+        self.recent_predictions.add(method, is_correct)
+        self.recent_method_accuracy.add(method, is_correct)
+
+        if len(self.current_sequence) >= self.min_pattern_length:
+            code = self.current_sequence.tail_code(self.min_pattern_length)
+            self.pattern_success_rate[code, 1] += 1
+            if is_correct:
+                self.pattern_success_rate[code, 0] += 1
+
+    def learn_online(self, actual):
+        # One SGD step on the window the last prediction was made from
+        if self.pending_features is None:
+            return
+        X = self.scaler.transform(self.pending_features)
+        self.online_classifier.partial_fit(X, [1 if actual == 'A' else 0])
+        self.pending_features = None
+
+    def refit_due(self):
+        return self.online_learning and self.chars_since_refit >= self.refit_interval
+
+    def refit_batch_models(self, training_sequence, new_bits):
+        # Fit clones of every model on the training sequence plus the characters seen
+        # since the last fit, keeping at most max(training length, max_sequence_length)
+        # characters. Nothing on self is changed; see publish_reanalysis.
+        sequence = self.refit_sequence(training_sequence, new_bits)
+        X, y = self.prepare_training_data(sequence)
+        scaler = clone(self.scaler)
+        X_scaled = self.scale_training_data(scaler, X)
+        rf_classifier = clone(self.rf_classifier).fit(X_scaled, y)
+        gb_classifier = clone(self.gb_classifier).fit(X_scaled, y)
+        online_classifier = self.fit_online_model(clone(self.online_classifier), X_scaled, y)
+        ensemble_table = self.compile_ensemble_table(scaler, rf_classifier, gb_classifier)
+        logging.info(f"Refit batch models on {len(sequence)} characters")
+        return {
+            'models': (scaler, rf_classifier, gb_classifier, online_classifier),
+            'ensemble_table': ensemble_table,
+            'sequence': sequence,
+            'new_chars': len(new_bits)
+        }
+
+    def refit_inputs(self):
+        # (training sequence, characters seen since it was fitted) for the next refit
+        new_chars = min(self.chars_since_refit, len(self.current_sequence))
+        # The training sequence buffer is replaced, never modified, so it is not copied
+        return self.sequence, self.current_sequence.bits(new_chars).copy()
+
+    def refit_sequence(self, training_sequence, new_bits):
+        bits = np.concatenate((training_sequence.bits(), new_bits))
+        return SequenceBuffer.fixed(bits[-max(len(training_sequence), self.max_sequence_length):])
 
     def enter_wait_state(self):
         self.prediction_state = 'WAITING'
 
         if not self.background_analysis_active:
-            self.background_analysis_active = True
-            self.executor.submit(self.perform_reanalysis)
-
-    def perform_reanalysis(self):
-        with self.reanalysis_lock:
-            try:
-                recent_sequence = self.current_sequence[-20:]
-                self.analyze_error_patterns(recent_sequence)
-                self.adjust_method_weights()
+            self.start_reanalysis()
+
+    def start_reanalysis(self, analyze_errors=True):
+        # Runs on the update queue: copy what the analysis reads and hand it to a
+        # background thread, which queues its results back through publish_reanalysis
+        self.background_analysis_active = True
+        if self.replaying:
+            # The journal holds the outcome if the job finished before the restart
+            return
+        job = {
+            'analyze_errors': analyze_errors,
+            'recent_sequence': self.current_sequence.bits(20).copy(),
+            'pattern_success_rate': self.pattern_success_rate.copy(),
+            'method_performance': {method: dict(stats) for method, stats in self.method_performance.items()},
+            'ensemble_weights': dict(self.ensemble_weights),
+            'refit': None
+        }
+        if self.refit_due():
+            job['refit'] = self.refit_inputs()
+        self.executor.submit(self.timed, 'perform_reanalysis', self.perform_reanalysis, job)
+
+    def perform_reanalysis(self, job):
+        result = {'analyze_errors': job['analyze_errors'], 'refit': None, 'ensemble_weights': None}
+        try:
+            if job['refit'] is not None:
+                result['refit'] = self.timed('refit_batch_models', self.refit_batch_models, *job['refit'])
+            if job['analyze_errors']:
+                recent_sequence = job['recent_sequence']
+                self.analyze_error_patterns(recent_sequence, job['pattern_success_rate'])
+                result['ensemble_weights'] = self.adjust_method_weights(job['method_performance'],
+                                                                        job['ensemble_weights'])
+                # Count tables are only ever incremented in place, so reading them here is safe
                 self.identify_new_patterns(recent_sequence)
+        except Exception as e:
+            logging.error(f"Reanalysis failed: {str(e)}")
+        finally:
+            self.updates.submit(self.run_update, self.publish_reanalysis, result)
+
+    def publish_reanalysis(self, result):
+        # Runs on the update queue, so predictions see either all of the new state or none of it
+        refit = result['refit']
+        if refit is not None:
+            self.scaler, self.rf_classifier, self.gb_classifier, self.online_classifier = refit['models']
+            self.ensemble_table = refit['ensemble_table']
+            self.model_generation += 1
+            self.sequence = refit['sequence']
+            self.chars_since_refit -= refit['new_chars']
+
+        if result['analyze_errors']:
+            if result['ensemble_weights'] is not None:
+                self.ensemble_weights = result['ensemble_weights']
+            self.consecutive_errors = 0
+            self.prediction_state = 'PREDICTING'
+        self.background_analysis_active = False
+        if self.journal is not None:
+            self.journal.record_reanalysis(self, result)
+
+    def run_update(self, method, *args):
+        result = method(*args)
+        self.publish_snapshot()
+        return result
+
+    def update(self, method, *args):
+        # Runs method on the update queue and publishes a new snapshot after it
+        return self.updates.call(self.run_update, method, *args)
+
+    def publish_snapshot(self):
+        last_prediction = self.last_prediction
+        if last_prediction is not None:
+            last_prediction = (last_prediction[0], float(last_prediction[1]), last_prediction[2])
+        self.snapshot = PredictorSnapshot(
+            version=self.snapshot.version + 1 if self.snapshot is not None else 0,
+            prediction_state=self.prediction_state,
+            last_prediction=last_prediction,
+            last_char=self.last_user_input,
+            consecutive_errors=self.consecutive_errors,
+            prediction_count=self.prediction_count,
+            chars_seen=self.chars_seen,
+            sequence_length=len(self.current_sequence),
+            method_performance={method: dict(stats) for method, stats in self.method_performance.items()},
+            ensemble_weights=dict(self.ensemble_weights),
+            published_at=time.time()
+        )
+        for listener in self.listeners:
+            try:
+                listener(self.snapshot)
+            except Exception as e:
+                logging.error(f"Snapshot listener failed: {str(e)}")
+        return self.snapshot
+
+    def add_listener(self, listener):
+        # Listeners must be quick and must not call back into the update queue
+        with self.listener_lock:
+            self.listeners = self.listeners + (listener,)
+
+    def remove_listener(self, listener):
+        with self.listener_lock:
+            self.listeners = tuple(other for other in self.listeners if other != listener)
+
+    def update_state(self, char):
+        # Fold one new character into the running statistics. Work is bounded by
+        # max_pattern_length, independent of how long the session has been running.
+        prev_char = self.current_sequence[-1] if self.current_sequence else None
+        window_length = min(len(self.current_sequence), self.max_pattern_length)
+        window_code = self.current_sequence.tail_code(window_length)
+        self.current_sequence.append(char)
+        self.cycle_detector.append(1 if char == 'A' else 0)
+        self.chars_since_refit += 1
+
+        if char in self.char_counts:
+            self.char_counts[char] += 1
+        self.chars_seen += 1
+        self.update_bayesian_priors()
+
+        if prev_char in self.transition_probs and char in self.transition_probs[prev_char]:
+            self.transition_probs[prev_char][char] += 1
+
+        self.time_patterns[self.current_hour()][char] += 1
+
+        self.pattern_database.add_code(window_code, window_length, char)
+        self.ngram_patterns.add_code(window_code, window_length, char)
+
+    def batch_model_probabilities(self, chars):
+        # RF and GB probabilities for the window ending at each of chars, as if they
+        # were appended one at a time. The ensemble features only depend on the
+        # sequence, so all rows can be scored in one predict_proba call per model.
+        context = self.current_sequence.bits(self.max_pattern_length - 1)
+        if len(context) < self.max_pattern_length - 1 or not chars or self.ensemble_table is not None:
+            # A compiled table answers each character faster than batch scoring
+            return None, None
+
+        bits = np.concatenate((context, to_bits(chars)))
+        X = self.scaler.transform(self.feature_extractor.transform_bits(bits, self.current_hour()))
+        return self.rf_classifier.predict_proba(X), self.gb_classifier.predict_proba(X)
+
+    def predict_batch(self, chars):
+        # predict_next(char) for each char as one update, scoring the ensemble models in one batch
+        return self.update(self.advance_batch, chars)
+
+    def advance_batch(self, chars):
+        rf_probs, gb_probs = self.batch_model_probabilities(chars)
+        predictions = []
+        for i, char in enumerate(chars):
+            model_probs = (rf_probs[i], gb_probs[i]) if rf_probs is not None else None
+            try:
+                predictions.append(self.advance(char, model_probs=model_probs))
+            except Exception as e:
+                raise BatchPredictionError(i, predictions, e) from e
+        return predictions
 
-                self.consecutive_errors = 0
-                self.prediction_state = 'PREDICTING'
-
-            finally:
-                self.background_analysis_active = False
+    def predict_next(self, last_char, model_probs=None):
+        return self.update(self.advance, last_char, model_probs)
 
-    def predict_next(self, last_char):
-        self.current_sequence += last_char
+    def advance(self, last_char, model_probs=None):
+        # Fold last_char in and predict the character after it; runs on the update queue
+        self.update_state(last_char)
         self.last_user_input = last_char
 
         if self.last_prediction is not None:
             self.verify_prediction(self.last_prediction, last_char)
 
         predictions = {
-            'ensemble': self.get_ensemble_prediction(),
-            'markov': self.get_markov_prediction(),
-            'pattern': self.get_pattern_prediction(),
-            'bayesian': self.get_bayesian_prediction(),
-            'cycle': self.get_cycle_prediction()
+            'ensemble': self.timed('get_ensemble_prediction', self.get_ensemble_prediction, model_probs),
+            'markov': self.timed('get_markov_prediction', self.get_markov_prediction),
+            'pattern': self.timed('get_pattern_prediction', self.get_pattern_prediction),
+            'bayesian': self.timed('get_bayesian_prediction', self.get_bayesian_prediction),
+            'cycle': self.timed('get_cycle_prediction', self.get_cycle_prediction)
         }
 
         weights = self.calculate_dynamic_weights()
         final_prediction = self.combine_predictions(predictions, weights)
 
         self.last_prediction = final_prediction
+        self.prediction_count += 1
         self.prediction_history.append({
             'prediction': final_prediction[0],
             'confidence': final_prediction[1],
@@ -331,12 +833,32 @@ class EnhancedGamePredictor:
             'timestamp': time.time()
         })
 
-        if self.prediction_state == 'WAITING' and not self.background_analysis_active:
-            self.background_analysis_active = True
-            self.executor.submit(self.perform_reanalysis)
+        if not self.background_analysis_active:
+            if self.prediction_state == 'WAITING':
+                self.start_reanalysis()
+            elif self.refit_due():
+                self.start_reanalysis(analyze_errors=False)
 
+        if self.journal is not None:
+            self.journal.record_prediction(self, last_char, final_prediction)
         return final_prediction
 
+    def memory_usage(self):
+        # Approximate bytes held by each component of this predictor, measured between updates
+        return self.updates.call(self.measure_memory)
+
+    def measure_memory(self):
+        return {
+            'sequence': self.sequence.nbytes + self.current_sequence.nbytes,
+            'pattern_database': self.pattern_database.nbytes + self.ngram_patterns.nbytes,
+            'cycle_detector': self.cycle_detector.samples.nbytes + self.cycle_detector.spectrum.nbytes,
+            'models': (model_sizeof(self.scaler) + model_sizeof(self.rf_classifier) +
+                       model_sizeof(self.gb_classifier) + model_sizeof(self.online_classifier)),
+            'ensemble_table': 0 if self.ensemble_table is None else self.ensemble_table.nbytes,
+            'history': (deep_sizeof(self.prediction_history) + deep_sizeof(self.accuracy_history) +
+                        self.pattern_success_rate.nbytes)
+        }
+
     def display_prediction(self, prediction):
         char, confidence, method = prediction
         confidence_pct = confidence * 100
@@ -350,52 +872,52 @@ class EnhancedGamePredictor:
         else:
             print(f"{Fore.RED}Wait for Next Character to add{Style.RESET_ALL}")
 
-    def analyze_error_patterns(self, sequence):
-        errors = []
-        for i in range(len(sequence) - 1):
-            pattern = sequence[i:i + self.min_pattern_length]
-            if pattern in self.pattern_success_rate:
-                stats = self.pattern_success_rate[pattern]
-                if stats['total'] > 0:
-                    error_rate = 1 - (stats['correct'] / stats['total'])
-                    errors.append((pattern, error_rate))
+    def analyze_error_patterns(self, sequence, pattern_success_rate=None):
+        if pattern_success_rate is None:
+            pattern_success_rate = self.pattern_success_rate
+        codes = window_codes(to_bits(sequence), self.min_pattern_length)
+        stats = pattern_success_rate[codes]
+        seen = stats[:, 1] > 0
+        error_rates = 1 - stats[seen, 0] / stats[seen, 1]
+
+        errors = [(decode_pattern(int(code), self.min_pattern_length), float(rate))
+                  for code, rate in zip(codes[seen], error_rates)]
         return sorted(errors, key=lambda x: x[1], reverse=True)
 
-    def adjust_method_weights(self):
-        total_correct = sum(stats['correct'] for stats in self.method_performance.values())
+    def adjust_method_weights(self, method_performance, ensemble_weights):
+        # Returns new ensemble weights; the arguments are left untouched
+        weights = dict(ensemble_weights)
+        total_correct = sum(stats['correct'] for stats in method_performance.values())
         if total_correct > 0:
-            for method in self.ensemble_weights:
-                if self.method_performance[method]['total'] > 0:
-                    accuracy = (self.method_performance[method]['correct'] /
-                                self.method_performance[method]['total'])
-                    self.ensemble_weights[method] = accuracy
+            for method in weights:
+                stats = method_performance.get(method)
+                if stats and stats['total'] > 0:
+                    weights[method] = stats['correct'] / stats['total']
+        return weights
 
     def identify_new_patterns(self, sequence):
+        # Every pattern already has a slot in the count tables, so just report
+        # the recent ones that have never been followed by a character
+        bits = to_bits(sequence)
+        new_patterns = []
         for length in range(self.min_pattern_length, self.max_pattern_length + 1):
-            for i in range(len(sequence) - length):
-                pattern = sequence[i:i + length]
-                if pattern not in self.pattern_database:
-                    self.pattern_database[pattern] = {'A': 0, 'B': 0}
+            codes = window_codes(bits, length)[:len(bits) - length]
+            if len(codes) == 0:
+                break
+            unseen = self.pattern_database.get_codes(length, codes).sum(axis=1) == 0
+            new_patterns.extend(decode_pattern(int(code), length) for code in codes[unseen])
+        return new_patterns
 
     def calculate_dynamic_weights(self):
+        # O(methods): overall and recent accuracy are maintained as running counters
         weights = {}
-        recent_window = min(50, len(self.prediction_history))
 
         for method in self.method_performance:
             correct = self.method_performance[method]['correct']
             total = self.method_performance[method]['total']
 
-            recent_correct = sum(1 for i in range(-recent_window, 0)
-                                 if i < len(self.prediction_history) and
-                                 self.prediction_history[i]['method'] == method and
-                                 self.prediction_history[i].get('correct', False))
-
-            recent_total = sum(1 for i in range(-recent_window, 0)
-                               if i < len(self.prediction_history) and
-                               self.prediction_history[i]['method'] == method)
-
             overall_accuracy = correct / total if total > 0 else 0
-            recent_accuracy = recent_correct / recent_total if recent_total > 0 else 0
+            recent_accuracy = self.recent_method_accuracy.accuracy(method)
 
             weights[method] = 0.4 * overall_accuracy + 0.6 * recent_accuracy
 
@@ -1,52 +1,161 @@
-from flask import Flask, request, jsonify
-from EnhancedGamePredictor import EnhancedGamePredictor  # Import the EnhancedGamePredictor class
-import logging
-import PyPDF2
-import io
-import re
+from flask import Blueprint, Flask, Response, current_app, g, request, jsonify
 from flask_cors import CORS
-app = Flask(__name__)
-CORS(app)
-
+from services import Services, DEFAULT_SESSION_ID, format_prediction, observe_training_phase
+from pdf_extraction import PDFLimitError, max_request_bytes
+import metrics
+import hmac
+import logging
+import os
+import time
+import json
 
-predictor = None
+# Heavy dependencies (sklearn, scipy, PyPDF2, ...) are imported lazily by Services
+api = Blueprint('api', __name__)
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 
-@app.route('/api/train', methods=['POST'])
-def train_model():
-    global predictor
+DEFAULT_BATCH_MAX_CHARS = 100000
+# /api/predict/batch applies this many characters per predictor update, so the
+# session's other requests are served between slices
+BATCH_SLICE_CHARS = 256
+# Browser origins allowed to call the public routes, comma separated in DASHBOARD_ORIGINS
+DEFAULT_DASHBOARD_ORIGINS = 'http://localhost:3000,http://127.0.0.1:3000'
+# Routes the dashboard calls from the browser. Admin and session routes are left
+# out, so other sites cannot call them through the user's browser.
+CORS_ROUTES = (r'/api/predict.*', r'/api/train.*', r'/api/ingest', r'/extract_text')
+
+
+def services():
+    return current_app.extensions['predictor_services']
+
+
+@api.before_app_request
+def start_services():
+    # No-op after the first request; see Services.start
+    services().start()
+
+
+@api.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.profiler = None
+    if not request.path.startswith(('/admin', '/metrics')):
+        g.profiler = services().request_profiler.begin()
+
+
+@api.after_app_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.HTTP_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    if 'request_start' in g:
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=endpoint)
+    return response
+
+
+@api.teardown_app_request
+def stop_request_profiler(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        services().request_profiler.end(profiler)
+
+
+@api.app_errorhandler(413)
+def request_too_large(e):
+    return jsonify({"error": f"Request is larger than the {max_request_bytes() // (1024 * 1024)} MB limit"}), 413
+
+
+def admin_allowed():
+    # The X-Admin-Token header must match ADMIN_TOKEN; without it admin routes are off.
+    # A local address alone proves nothing, as browser pages can call localhost too.
+    token = os.environ.get('ADMIN_TOKEN')
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+
+def get_session_id(data=None):
+    # Session id comes from the X-Session-Id header or the request body
+    session_id = request.headers.get('X-Session-Id')
+    if not session_id and data:
+        session_id = data.get('session_id')
+    return str(session_id) if session_id else DEFAULT_SESSION_ID
 
+
+def start_training(app_services, session_id, load_sequence, sequence_length=0, phases=()):
+    # Submits a training job for the sequence returned by load_sequence(job).
+    # Training runs outside the app context, so the services are resolved up front.
+    predictor_class = app_services.predictor_class
+
+    def train(job):
+        sequence = load_sequence(job)
+        # Initialize the predictor with the sequence, reusing a cached model when possible
+        return app_services.model_cache.load_or_train(predictor_class, sequence,
+                                                      progress_callback=observe_training_phase(job))
+
+    def publish(session_id, predictor):
+        app_services.publish(session_id, predictor)
+        logging.info(f"Model trained successfully for session {session_id}.")
+
+    return app_services.training_jobs.submit(session_id, sequence_length, train, publish,
+                                             expected_phases=tuple(phases) + predictor_class.TRAINING_PHASES)
+
+
+def training_response(job, wait=False, **extra):
+    # Clients that cannot poll may ask to block until the job is done
+    if wait:
+        job.done.wait()
+        if job.status == 'failed':
+            logging.error(f"Error training model: {job.error}")
+            return jsonify({"error": job.error, "job": job.to_dict(), **extra}), 500
+        return jsonify({"message": "Model trained successfully", "job": job.to_dict(), **extra}), 200
+
+    return jsonify({
+        "message": "Training started",
+        "job_id": job.job_id,
+        "status_url": f"/api/train/{job.job_id}",
+        **extra
+    }), 202
+
+
+@api.route('/api/train', methods=['POST'])
+def train_model():
     # Get the sequence from the request body
     data = request.get_json()
     sequence = data.get('sequence')
+    session_id = get_session_id(data)
 
     if not sequence:
         return jsonify({"error": "Sequence is required"}), 400
 
-    try:
-        # Initialize the predictor with the provided sequence
-        predictor = EnhancedGamePredictor(sequence)
-        logging.info("Model trained successfully.")
-        return jsonify({"message": "Model trained successfully"}), 200
+    if not isinstance(sequence, str) or set(sequence) - {'A', 'B'}:
+        logging.error("Invalid training sequence: characters must all be 'A' or 'B'")
+        return jsonify({"error": "Invalid input. Sequence must only contain 'A' and 'B' characters."}), 400
 
-    except Exception as e:
-        logging.error(f"Error training model: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+    app_services = services()
+    job = start_training(app_services, session_id, lambda job: sequence, len(sequence))
+    return training_response(job, data.get('wait'))
 
 
-@app.route('/api/predict', methods=['POST'])
-def predict():
-    global predictor
+@api.route('/api/train/<job_id>', methods=['GET'])
+def training_status(job_id):
+    job = services().training_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown training job '{job_id}'"}), 404
+    return jsonify(job.to_dict()), 200
 
-    if predictor is None:
-        logging.error("Model has not been trained. Call /api/train first.")
-        return jsonify({"error": "Model has not been trained. Call /api/train first."}), 400
 
+@api.route('/api/predict', methods=['POST'])
+def predict():
     # Get the last character from the request
     data = request.get_json()
     last_char = data.get('last_char')
+    session_id = get_session_id(data)
+
+    predictor = services().registry.get(session_id)
+    if predictor is None:
+        logging.error(f"Model has not been trained for session {session_id}. Call /api/train first.")
+        return jsonify({"error": "Model has not been trained. Call /api/train first."}), 400
 
     if last_char not in ['A', 'B']:
         logging.error(f"Invalid input. Last character must be 'A' or 'B'. Received: {last_char}")
@@ -55,39 +164,96 @@ def predict():
     try:
         # Call the predict_next method of your predictor
         prediction = predictor.predict_next(last_char.upper())  # Use the uppercase 'A' or 'B'
-        predicted_char, confidence, method = prediction  # Unpack the result
-
-        # Confidence threshold logic to determine the response message and color
-        confidence_pct = confidence * 100
-        if confidence_pct >= 80 and predicted_char == last_char:
-            if predicted_char == 'A':
-                message = "Next Character = 'A'"
-                color = "green"
-            else:
-                message = "Next Character = 'B'"
-                color = "blue"
-        else:
-            message = "Wait for next character."
-            color = "red"
 
         # Return the prediction response with color and message
-        return jsonify({
-            "message": message,
-            "color": color
-        }), 200
+        return jsonify(format_prediction(prediction, last_char)), 200
 
     except Exception as e:
         logging.error(f"Error during prediction: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 
-# Helper function to extract only 'A' and 'B' characters from text
-def extract_a_and_b(text):
-    return ''.join(re.findall(r'[AB]', text))
+@api.route('/api/predict/batch', methods=['POST'])
+def predict_batch():
+    # Replays a string of characters through the predictor, streaming one NDJSON line per step
+    data = request.get_json()
+    chars = data.get('chars')
+    session_id = get_session_id(data)
+
+    predictor = services().registry.get(session_id)
+    if predictor is None:
+        logging.error(f"Model has not been trained for session {session_id}. Call /api/train first.")
+        return jsonify({"error": "Model has not been trained. Call /api/train first."}), 400
+
+    if not chars or not isinstance(chars, str) or set(chars) - {'A', 'B'}:
+        logging.error(f"Invalid input. Characters must all be 'A' or 'B'. Received: {chars}")
+        return jsonify({"error": "Invalid input. Please provide a string of 'A' and 'B' characters."}), 400
+
+    max_chars = int(os.environ.get('PREDICT_BATCH_MAX_CHARS', DEFAULT_BATCH_MAX_CHARS))
+    if len(chars) > max_chars:
+        return jsonify({"error": f"At most {max_chars} characters can be replayed per request"}), 413
+
+    def steps(start, predictions):
+        for index, prediction in enumerate(predictions, start):
+            step = {"index": index, "last_char": chars[index]}
+            step.update(format_prediction(prediction, chars[index]))
+            yield json.dumps(step) + '\n'
+
+    def generate():
+        from EnhancedGamePredictor import BatchPredictionError
+        for start in range(0, len(chars), BATCH_SLICE_CHARS):
+            try:
+                predictions = predictor.predict_batch(chars[start:start + BATCH_SLICE_CHARS])
+            except BatchPredictionError as e:
+                # Characters before the failing one were applied, so they are still reported
+                yield from steps(start, e.predictions)
+                logging.error(f"Error during batch prediction: {str(e)}")
+                yield json.dumps({"index": start + e.index, "error": str(e)}) + '\n'
+                return
+            except Exception as e:
+                logging.error(f"Error during batch prediction: {str(e)}")
+                yield json.dumps({"index": start, "error": str(e)}) + '\n'
+                return
+            yield from steps(start, predictions)
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+@api.route('/api/sessions', methods=['GET'])
+def session_stats():
+    # Per-session memory and activity stats. Lists every session id, so admins only.
+    if not admin_allowed():
+        return jsonify({"error": "Forbidden"}), 403
+
+    refresh = request.args.get('refresh', '').lower() in ('1', 'true', 'yes')
+    stats = services().registry.stats(refresh=refresh)
+    stats['model_cache'] = services().model_cache.summary()
+    return jsonify(stats), 200
+
+
+@api.route('/api/sessions/<session_id>', methods=['GET'])
+def session_snapshot(session_id):
+    # Latest published state of a session; never waits for in-flight updates
+    predictor = services().registry.peek(session_id)
+    if predictor is None:
+        return jsonify({"error": f"Unknown session '{session_id}'"}), 404
+    snapshot = predictor.snapshot._asdict()
+    snapshot['session_id'] = session_id
+    return jsonify(snapshot), 200
+
+
+@api.route('/api/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    if not admin_allowed():
+        return jsonify({"error": "Forbidden"}), 403
+
+    if not services().registry.remove(session_id):
+        return jsonify({"error": f"Unknown session '{session_id}'"}), 404
+    return jsonify({"message": f"Session '{session_id}' removed"}), 200
 
 
 # Route to extract text from PDF file
-@app.route('/extract_text', methods=['POST'])
+@api.route('/extract_text', methods=['POST'])
 def extract_text_from_pdf():
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
@@ -95,22 +261,141 @@ def extract_text_from_pdf():
     file = request.files['file']
 
     try:
-        # Read and parse the uploaded PDF
-        pdf_file = io.BytesIO(file.read())
-        reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text()
+        # Spool and parse the uploaded PDF, keeping only 'A' and 'B' characters per page
+        start = time.perf_counter()
+        result_text, info = services().pdf_extractor.extract(file.stream)
+        if not info['cached']:
+            metrics.PDF_PAGES.inc(info['pages'])
+        metrics.PDF_EXTRACTION_SECONDS.observe(time.perf_counter() - start)
 
-        # Extract 'A' and 'B' characters and reverse the result
-        result_text = extract_a_and_b(text)
-        reversed_text = result_text[::-1]  # Reverse the extracted text
+        # Reverse the extracted text
+        reversed_text = result_text[::-1]
 
         return jsonify({'text': reversed_text}), 200
 
+    except PDFLimitError as e:
+        return jsonify({'error': str(e)}), 413
+
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@api.route('/api/ingest', methods=['POST'])
+def ingest_pdfs():
+    # Extracts one or more PDFs and trains on them in one step, without sending
+    # the sequence to the client and back. Files are concatenated in upload
+    # order, each one reversed as /extract_text returns it.
+    files = request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No file provided'}), 400
+    session_id = get_session_id(request.form)
+
+    app_services = services()
+    extractor = app_services.pdf_extractor
+    try:
+        # Uploads are spooled here, as the request streams are gone once the response is sent
+        spooled = extractor.spool_many([file.stream for file in files])
+    except PDFLimitError as e:
+        return jsonify({'error': str(e)}), 413
+
+    names = [file.filename for file in files]
+
+    def load_sequence(job):
+        # Runs in the training job, which parses all files concurrently
+        start = time.perf_counter()
+        results = extractor.extract_spooled(spooled)
+        seconds = time.perf_counter() - start
+        for _, info in results:
+            if not info['cached']:
+                metrics.PDF_PAGES.inc(info['pages'])
+        metrics.PDF_EXTRACTION_SECONDS.observe(seconds)
+        observe_training_phase(job)('extract_pdfs', seconds)
+
+        sequence = ''.join(text[::-1] for text, _ in results)
+        job.sequence_length = len(sequence)
+        job.details['files'] = [dict(info, name=name, characters=len(text))
+                                for name, (text, info) in zip(names, results)]
+        # Last characters of the sequence, which the client shows as the current history
+        job.details['tail'] = sequence[-10:]
+        if not sequence:
+            raise ValueError("No valid sequence found in the uploaded PDFs")
+        return sequence
+
+    job = start_training(app_services, session_id, load_sequence, phases=('extract_pdfs',))
+    return training_response(job, request.form.get('wait', '').lower() in ('1', 'true', 'yes'), files=names)
+
+
+@api.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Memory gauges are taken from the registry at scrape time, if this worker has one.
+    # They are summed over sessions: session ids are chosen by clients, so they are
+    # neither exposed here nor allowed to grow the label set.
+    app_services = services()
+    memory = {}
+    if 'registry' in app_services.loaded():
+        stats = app_services.registry.stats()
+        for session in stats['sessions'].values():
+            for component, size in session['memory_breakdown'].items():
+                memory[component] = memory.get(component, 0) + size
+        metrics.ACTIVE_SESSIONS.set(stats['active_sessions'])
+    metrics.PREDICTOR_MEMORY.replace((size, {'component': component}) for component, size in memory.items())
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+@api.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def profile_requests():
+    # POST {"requests": N} profiles the next N requests, GET returns the aggregated stats
+    if not admin_allowed():
+        return jsonify({"error": "Forbidden"}), 403
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            requests_to_sample = int(data.get('requests', 100))
+        except (TypeError, ValueError):
+            return jsonify({"error": "requests must be an integer"}), 400
+        if requests_to_sample <= 0:
+            return jsonify({"error": "requests must be positive"}), 400
+        services().request_profiler.start(requests_to_sample)
+        return jsonify({"message": f"Profiling the next {requests_to_sample} requests"}), 200
+
+    if request.method == 'DELETE':
+        services().request_profiler.stop()
+
+    sort = request.args.get('sort', 'cumulative')
+    limit = request.args.get('limit', 50, type=int)
+    try:
+        return jsonify(services().request_profiler.report(sort=sort, limit=limit)), 200
+    except KeyError:
+        return jsonify({"error": f"Unknown sort key '{sort}'"}), 400
+
+
+def create_app(preload=None):
+    # Application factory. With PRELOAD_SEQUENCE_FILE (or preload=path) a default
+    # model is trained or loaded from the model cache when the server starts.
+    # Sessions, training jobs and journals live in this process, so serve the app
+    # from a single process with threads: `python app.py`, `uvicorn
+    # stream:application`, or gunicorn with the gunicorn.conf.py next to this file,
+    # which refuses to start more than one worker.
+    if preload is None:
+        preload = os.environ.get('PRELOAD_SEQUENCE_FILE')
+    app = Flask(__name__)
+    # Larger requests are refused before Werkzeug receives and spools them
+    app.config['MAX_CONTENT_LENGTH'] = max_request_bytes()
+    origins = [origin.strip() for origin in
+               os.environ.get('DASHBOARD_ORIGINS', DEFAULT_DASHBOARD_ORIGINS).split(',') if origin.strip()]
+    CORS(app, resources={route: {'origins': origins} for route in CORS_ROUTES})
+    app.extensions['predictor_services'] = Services(preload_file=preload)
+    app.register_blueprint(api)
+    return app
+
+
+app = create_app()
+
+
 if __name__ == "__main__":
+    # The debug reloader runs this module in a parent and a serving child; only
+    # the child starts the services, before it accepts requests
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        app.extensions['predictor_services'].start()
     app.run(debug=True, port=5959)
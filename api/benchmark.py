@@ -0,0 +1,207 @@
+import argparse
+import json
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from functools import wraps
+
+import numpy as np
+
+from EnhancedGamePredictor import EnhancedGamePredictor
+
+
+# Predictor methods timed individually during the walk
+TIMED_METHODS = ('update_state', 'verify_prediction', 'get_ensemble_prediction', 'get_markov_prediction',
+                 'get_pattern_prediction', 'get_bayesian_prediction', 'get_cycle_prediction',
+                 'calculate_dynamic_weights', 'combine_predictions')
+
+# get_*_prediction method -> key used in predict_next's predictions dict
+PREDICTION_METHODS = {
+    'get_ensemble_prediction': 'ensemble',
+    'get_markov_prediction': 'markov',
+    'get_pattern_prediction': 'pattern',
+    'get_bayesian_prediction': 'bayesian',
+    'get_cycle_prediction': 'cycle'
+}
+
+
+def synthetic_sequence(length, seed=0, repeat_probability=0.55, period=None):
+    # Two-state Markov chain, optionally overlaid with a fixed period
+    rng = random.Random(seed)
+    chars = ['A']
+    for i in range(1, length):
+        if period and i >= period and rng.random() < 0.5:
+            chars.append(chars[i - period])
+        elif rng.random() < repeat_probability:
+            chars.append(chars[-1])
+        else:
+            chars.append('B' if chars[-1] == 'A' else 'A')
+    return ''.join(chars)
+
+
+def load_sequence(path):
+    with open(path) as f:
+        return ''.join(c for c in f.read().upper() if c in 'AB')
+
+
+def latency_summary(samples):
+    if not samples:
+        return {'calls': 0}
+    values = np.array(samples) * 1e6
+    return {
+        'calls': len(values),
+        'mean_us': round(float(values.mean()), 3),
+        'p50_us': round(float(np.percentile(values, 50)), 3),
+        'p95_us': round(float(np.percentile(values, 95)), 3),
+        'p99_us': round(float(np.percentile(values, 99)), 3),
+        'max_us': round(float(values.max()), 3)
+    }
+
+
+def peak_rss_bytes():
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class MethodTimer:
+    # Shadows predictor methods with timing wrappers on the instance and keeps
+    # the last answer of each get_*_prediction method for accuracy scoring
+
+    def __init__(self, predictor, methods=TIMED_METHODS):
+        self.latencies = defaultdict(list)
+        self.last_results = {}
+        for name in methods:
+            setattr(predictor, name, self.wrap(name, getattr(predictor, name)))
+
+    def wrap(self, name, method):
+        @wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            self.latencies[name].append(time.perf_counter() - start)
+            if name in PREDICTION_METHODS:
+                self.last_results[PREDICTION_METHODS[name]] = result
+            return result
+        return timed
+
+
+def run_benchmark(sequence, train_length, walk_length=None, trace_memory=False, predictor_kwargs=None):
+    training_sequence = sequence[:train_length]
+    walk = sequence[train_length:]
+    if walk_length is not None:
+        walk = walk[:walk_length]
+    if len(training_sequence) <= 13 or not walk:
+        raise ValueError("Need more than 13 training characters and at least one character to walk")
+
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    predictor = EnhancedGamePredictor(training_sequence, **(predictor_kwargs or {}))
+    training_seconds = time.perf_counter() - start
+    training_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.reset_peak()
+
+    timer = MethodTimer(predictor)
+    call_latencies = []
+    method_hits = defaultdict(lambda: {'correct': 0, 'total': 0})
+    final_hits = {'correct': 0, 'total': 0}
+    pending = None
+
+    walk_start = time.perf_counter()
+    for char in walk:
+        # Score the previous step's answers against the character that actually came
+        if pending is not None:
+            method_answers, final_answer = pending
+            for method, (predicted, _) in method_answers.items():
+                method_hits[method]['total'] += 1
+                method_hits[method]['correct'] += predicted == char
+            final_hits['total'] += 1
+            final_hits['correct'] += final_answer == char
+
+        call_start = time.perf_counter()
+        prediction = predictor.predict_next(char)
+        call_latencies.append(time.perf_counter() - call_start)
+        pending = (dict(timer.last_results), prediction[0])
+    walk_seconds = time.perf_counter() - walk_start
+
+    walk_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    if trace_memory:
+        tracemalloc.stop()
+    predictor.executor.shutdown(wait=True)
+
+    def accuracy(hits):
+        return round(hits['correct'] / hits['total'], 6) if hits['total'] else None
+
+    return {
+        'sequence_length': len(sequence),
+        'train_length': len(training_sequence),
+        'walk_length': len(walk),
+        'training': {
+            'total_seconds': round(training_seconds, 6),
+            'phase_seconds': {phase: round(seconds, 6) for phase, seconds in predictor.phase_timings.items()}
+        },
+        'walk': {
+            'total_seconds': round(walk_seconds, 6),
+            'throughput_per_second': round(len(walk) / walk_seconds, 3) if walk_seconds else None,
+            'predict_next': latency_summary(call_latencies),
+            'methods': {name: latency_summary(samples) for name, samples in timer.latencies.items()}
+        },
+        'accuracy': {
+            'final': accuracy(final_hits),
+            'methods': {method: accuracy(hits) for method, hits in method_hits.items()},
+            'best_method_performance': predictor.method_performance
+        },
+        'memory': {
+            'peak_rss_bytes': peak_rss_bytes(),
+            'training_peak_traced_bytes': training_peak,
+            'walk_peak_traced_bytes': walk_peak,
+            'predictor_bytes': predictor.memory_usage()
+        }
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Walk-forward replay benchmark for EnhancedGamePredictor")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--sequence-file', help="Text file with the A/B history (other characters are ignored)")
+    source.add_argument('--length', type=int, default=5000, help="Length of a synthetic sequence")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--period', type=int, default=None, help="Overlay a cycle of this period on synthetic data")
+    parser.add_argument('--train-fraction', type=float, default=0.8)
+    parser.add_argument('--train-length', type=int, default=None, help="Overrides --train-fraction")
+    parser.add_argument('--walk-length', type=int, default=None, help="Limit the number of replayed characters")
+    parser.add_argument('--trace-memory', action='store_true', help="Track Python heap peaks with tracemalloc (slow)")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.sequence_file:
+        sequence = load_sequence(args.sequence_file)
+    else:
+        sequence = synthetic_sequence(args.length, seed=args.seed, period=args.period)
+    train_length = args.train_length or int(len(sequence) * args.train_fraction)
+
+    report = run_benchmark(sequence, train_length, walk_length=args.walk_length, trace_memory=args.trace_memory)
+    report['environment'] = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'source': args.sequence_file or f'synthetic(length={args.length}, seed={args.seed}, period={args.period})',
+        'timestamp': time.time()
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=int)
+    else:
+        print(json.dumps(report, indent=2, default=int))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import logging
+import os
+import tempfile
+import weakref
+
+import numpy as np
+
+
+DEFAULT_CHUNK_ROWS = 65536
+DEFAULT_MAX_ROWS = 200000
+DEFAULT_STRIDE = 1
+SAMPLING_MODES = ('reservoir', 'stride')
+
+
+def augmented_bits(bits, start, stop):
+    # augmented[start:stop] of augmented = bits + reversed bits + inverted bits
+    # (see EnhancedGamePredictor.augment_training_data), without building it
+    n = len(bits)
+    parts = []
+    for segment in range(3):
+        lo, hi = max(start, segment * n) - segment * n, min(stop, (segment + 1) * n) - segment * n
+        if lo >= hi:
+            continue
+        if segment == 0:
+            parts.append(bits[lo:hi])
+        elif segment == 1:
+            parts.append(bits[n - hi:n - lo][::-1])
+        else:
+            parts.append(1 - bits[lo:hi])
+    if not parts:
+        return bits[:0]
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def remove_file(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def disk_matrix(directory, rows, columns):
+    # float32 matrix backed by a temporary file. The file is unlinked straight away
+    # where the platform allows it, otherwise when the array is garbage collected.
+    fd, path = tempfile.mkstemp(prefix='training-', suffix='.f32', dir=directory)
+    os.close(fd)
+    X = np.memmap(path, dtype=np.float32, mode='w+', shape=(max(rows, 1), columns))[:rows]
+    try:
+        os.unlink(path)
+    except OSError:
+        weakref.finalize(X.base, remove_file, path)
+    return X
+
+
+class ChunkedTrainingData:
+    # Builds the training matrix of a long history without holding it in memory.
+    # At most max_rows windows of the augmented sequence are selected up front
+    # (the last max_rows of every stride-th one, or a reservoir sample that
+    # keeps the share of A and B labels), their features are generated chunk_rows at a time into a
+    # float32 memmap, and the scaler is fitted and applied in streaming passes
+    # over it. Peak memory is a few chunks plus the selected rows' labels.
+
+    def __init__(self, sampling=None, max_rows=None, stride=None, chunk_rows=None, directory=None,
+                 random_state=None):
+        if sampling is None:
+            sampling = os.environ.get('PREDICTOR_TRAINING_SAMPLING', 'reservoir')
+        if max_rows is None:
+            max_rows = int(os.environ.get('PREDICTOR_TRAINING_ROWS', DEFAULT_MAX_ROWS))
+        if stride is None:
+            stride = int(os.environ.get('PREDICTOR_TRAINING_STRIDE', DEFAULT_STRIDE))
+        if chunk_rows is None:
+            chunk_rows = int(os.environ.get('PREDICTOR_TRAINING_CHUNK_ROWS', DEFAULT_CHUNK_ROWS))
+        if directory is None:
+            directory = os.environ.get('PREDICTOR_TRAINING_DIR') or None
+        if sampling not in SAMPLING_MODES:
+            raise ValueError(f"Unknown sampling mode '{sampling}', expected one of {SAMPLING_MODES}")
+
+        self.sampling = sampling
+        self.max_rows = max(1, max_rows)
+        self.stride = max(1, stride)
+        self.chunk_rows = max(1, chunk_rows)
+        self.directory = directory
+        self.random_state = random_state
+
+    def params(self):
+        # What changes the fitted models, for EnhancedGamePredictor.hyperparameters
+        if self.sampling == 'stride':
+            return {'sampling': 'stride', 'stride': self.stride, 'max_rows': self.max_rows}
+        return {'sampling': 'reservoir', 'max_rows': self.max_rows, 'random_state': self.random_state}
+
+    def chunks(self, n_rows):
+        for start in range(0, n_rows, self.chunk_rows):
+            yield start, min(start + self.chunk_rows, n_rows)
+
+    def select_rows(self, bits, window, n_rows):
+        # Sorted start positions of the windows to train on
+        if self.sampling == 'stride':
+            # The most recent max_rows of every stride-th window, without listing the others
+            strided = -(-n_rows // self.stride)
+            return np.arange(max(0, strided - self.max_rows) * self.stride, n_rows, self.stride)
+        if n_rows <= self.max_rows:
+            return np.arange(n_rows)
+
+        # One reservoir (Algorithm R) per label, then a share of each reservoir
+        # proportional to how often its label occurs
+        rng = np.random.default_rng(self.random_state)
+        reservoirs = [np.empty(self.max_rows, dtype=np.int64) for _ in range(2)]
+        seen = [0, 0]
+        for start, stop in self.chunks(n_rows):
+            labels = augmented_bits(bits, start + window, stop + window)
+            for label in (0, 1):
+                rows = start + np.flatnonzero(labels == label)
+                reservoir, k = reservoirs[label], self.max_rows
+                positions = seen[label] + np.arange(len(rows))
+                seen[label] += len(rows)
+
+                filling = positions < k
+                reservoir[positions[filling]] = rows[filling]
+                rows, positions = rows[~filling], positions[~filling]
+                if not len(rows):
+                    continue
+                slots = rng.integers(0, positions + 1)
+                keep = slots < k
+                # A slot drawn twice in one chunk ends with the later row, as in the sequential algorithm
+                slots, last = np.unique(slots[keep][::-1], return_index=True)
+                reservoir[slots] = rows[keep][::-1][last]
+
+        selected = []
+        for label in (0, 1):
+            share = int(round(self.max_rows * seen[label] / n_rows))
+            kept = min(seen[label], self.max_rows)
+            selected.append(rng.choice(reservoirs[label][:kept], size=min(share, kept), replace=False))
+        return np.sort(np.concatenate(selected))
+
+    def training_data(self, extractor, bits, hour):
+        # Same rows as BatchFeatureExtractor.training_data on the augmented
+        # sequence, restricted to the selected windows. X is a float32 memmap.
+        window = extractor.window
+        n_rows = max(0, 3 * len(bits) - window)
+        starts = self.select_rows(bits, window, n_rows)
+
+        X = disk_matrix(self.directory, len(starts), extractor.n_features)
+        y = np.empty(len(starts), dtype=np.int64)
+        for start, stop in self.chunks(n_rows):
+            lo, hi = np.searchsorted(starts, (start, stop))
+            if lo == hi:
+                continue
+            chunk = augmented_bits(bits, start, stop + window)
+            rows = starts[lo:hi] - start
+            X[lo:hi] = extractor.transform_bits(chunk, hour, starts=rows, dtype=np.float32)
+            y[lo:hi] = chunk[rows + window]
+
+        logging.info(f"Prepared {len(starts)} of {n_rows} training windows out of core ({self.sampling})")
+        return X, y
+
+    def fit_transform(self, scaler, X):
+        # StandardScaler.fit_transform in place: one pass for the statistics, one to scale
+        for start, stop in self.chunks(len(X)):
+            if start == 0:
+                scaler.fit(X[start:stop])
+            else:
+                scaler.partial_fit(X[start:stop])
+        for start, stop in self.chunks(len(X)):
+            X[start:stop] = scaler.transform(X[start:stop])
+        return X
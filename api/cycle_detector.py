@@ -0,0 +1,91 @@
+import numpy as np
+from scipy.fft import rfft
+
+
+class CycleDetector:
+    # Tracks the spectrum of the last `window` samples with a sliding DFT, so each
+    # new character costs O(window) no matter how long the session runs. The
+    # spectrum is recomputed from scratch every `resync_interval` updates to keep
+    # floating point drift in check.
+
+    def __init__(self, window=512, resync_interval=None):
+        if window < 4:
+            raise ValueError("window must be at least 4")
+        self.window = window
+        self.resync_interval = resync_interval or window
+        self.bins = np.arange(1, window // 2)
+        self.twiddle = np.exp(2j * np.pi * self.bins / window)
+
+        self.samples = np.zeros(window)
+        self.pos = 0
+        self.count = 0
+        self.spectrum = np.zeros(len(self.bins), dtype=complex)
+        self.synced = False
+        self.updates_since_sync = 0
+        self.cached_period = None
+
+    def __len__(self):
+        return min(self.count, self.window)
+
+    def append(self, value):
+        old = self.samples[self.pos]
+        self.samples[self.pos] = value
+        self.pos = (self.pos + 1) % self.window
+        self.count += 1
+        self.cached_period = None
+
+        if self.synced and self.count > self.window:
+            self.spectrum = (self.spectrum + (value - old)) * self.twiddle
+            self.updates_since_sync += 1
+            if self.updates_since_sync >= self.resync_interval:
+                self.synced = False
+        else:
+            self.synced = False
+
+    def extend(self, values):
+        for value in values[-self.window:]:
+            self.append(value)
+
+    def ordered_samples(self):
+        # Samples oldest first
+        if self.count < self.window:
+            return self.samples[:self.count]
+        return np.concatenate((self.samples[self.pos:], self.samples[:self.pos]))
+
+    def resync(self):
+        self.spectrum = rfft(self.ordered_samples())[1:self.window // 2]
+        self.synced = True
+        self.updates_since_sync = 0
+
+    def dominant_period(self):
+        # (period, strength): the period of the strongest non-DC bin and that
+        # bin's share of the total non-DC power
+        if self.cached_period is not None:
+            return self.cached_period
+
+        n = len(self)
+        if n < 4:
+            return 0, 0.0
+
+        if n < self.window:
+            # Window not full yet: analyse what we have directly
+            magnitudes = np.abs(rfft(self.ordered_samples())[1:n // 2])
+        else:
+            if not self.synced:
+                self.resync()
+            magnitudes = np.abs(self.spectrum)
+
+        if len(magnitudes) == 0:
+            return 0, 0.0
+
+        dominant = int(np.argmax(magnitudes))
+        power = magnitudes ** 2
+        total_power = power.sum()
+        strength = float(power[dominant] / total_power) if total_power > 0 else 0.0
+
+        self.cached_period = (n // (dominant + 1), strength)
+        return self.cached_period
+
+    def value_at(self, offset):
+        # Sample `offset` steps back from the newest (offset=1 is the newest)
+        return self.samples[(self.pos - offset) % self.window]
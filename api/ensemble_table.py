@@ -0,0 +1,60 @@
+import numpy as np
+
+
+HOURS = 24
+
+
+def splits_on(model, columns):
+    # Whether a fitted tree ensemble has a split on any of the feature columns.
+    # Other models are assumed to use every feature.
+    estimators = getattr(model, 'estimators_', None)
+    if estimators is None:
+        return True
+    return any(np.isin(tree.tree_.feature, columns).any() for tree in np.ravel(estimators))
+
+
+class EnsembleTable:
+    # Batch model probabilities for every input the ensemble can be given. The
+    # features only depend on the last `window` characters and the hour, so all
+    # 2^window windows are scored once per hour and a prediction becomes an index
+    # by SequenceBuffer.tail_code. Training rows all share one hour, so the trees
+    # rarely split on the hour features; the table then has a single hour row.
+
+    def __init__(self, names, probabilities):
+        self.names = tuple(names)
+        # (model, hour, window code, class)
+        self.probabilities = probabilities
+        self.weights = None
+        self.combined = None
+
+    @classmethod
+    def compile(cls, extractor, scaler, models):
+        # models: {ensemble weight name: fitted classifier}; None when a model was
+        # fitted on a single class and has no probability for the other one
+        if any(len(getattr(model, 'classes_', ())) != 2 for model in models.values()):
+            return None
+        hour_columns = [extractor.window + 2, extractor.window + 3]
+        hourly = any(splits_on(model, hour_columns) for model in models.values())
+        hours = range(HOURS) if hourly else range(1)
+
+        X = scaler.transform(np.concatenate([extractor.every_window(hour) for hour in hours]))
+        probabilities = np.stack([model.predict_proba(X).reshape(len(hours), -1, 2)
+                                  for model in models.values()])
+        return cls(models, probabilities)
+
+    @property
+    def nbytes(self):
+        return self.probabilities.nbytes + (0 if self.combined is None else self.combined.nbytes)
+
+    def model_probs(self, hour, code):
+        # One probability row per model, as predict_proba would return them
+        return tuple(self.probabilities[:, hour % self.probabilities.shape[1], code])
+
+    def lookup(self, hour, code, weights):
+        # Weighted average of the model rows. The combined table is rebuilt when
+        # the weights differ from the ones it was built with.
+        key = tuple(weights[name] for name in self.names)
+        if key != self.weights:
+            self.combined = sum(probs * weight for probs, weight in zip(self.probabilities, key)) / sum(key)
+            self.weights = key
+        return self.combined[hour % len(self.combined), code]
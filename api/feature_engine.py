@@ -0,0 +1,105 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from sequence_buffer import to_bits
+
+
+def entropy_table(window):
+    # Entropy of a window only depends on how many A's it holds, so the scalar
+    # formula is evaluated once per count
+    table = np.zeros(window + 1)
+    for count_a in range(window + 1):
+        freq_a = count_a / window
+        freq_b = 1 - freq_a
+        if freq_a == 0 or freq_b == 0:
+            continue
+        table[count_a] = -(freq_a * np.log2(freq_a) + freq_b * np.log2(freq_b))
+    return table
+
+
+def complexity_table(window, entropies):
+    # Complexity of a window (mean of its entropy, share of distinct characters
+    # and transition rate) as a function of (A count, transition count)
+    table = np.zeros((window + 1, max(window, 1)))
+    for count_a in range(window + 1):
+        repetition_score = (1 if count_a in (0, window) else 2) / window
+        for transitions in range(max(window, 1)):
+            transition_score = transitions / (window - 1) if window > 1 else 0
+            table[count_a, transitions] = np.mean([entropies[count_a], repetition_score, transition_score])
+    return table
+
+
+class BatchFeatureExtractor:
+    # Features of a window of characters: its bits (A = 1), share of A's, entropy,
+    # the hour as sin / cos, and complexity. Computed for every window in one pass.
+
+    def __init__(self, window):
+        self.window = window
+        self.entropies = entropy_table(window)
+        self.complexities = complexity_table(window, self.entropies)
+
+    @property
+    def n_features(self):
+        return self.window + 5
+
+    def transform_bits(self, bits, hour, n_windows=None, starts=None, dtype=np.float64):
+        # Features for windows bits[i:i + window], i < n_windows, or only for the
+        # windows starting at `starts` when given
+        window = self.window
+        if n_windows is None:
+            n_windows = len(bits) - window + 1
+        n_windows = max(0, min(n_windows, len(bits) - window + 1))
+        rows = n_windows if starts is None else len(starts)
+        X = np.empty((rows, self.n_features), dtype=dtype)
+        if rows == 0:
+            return X
+
+        windows = sliding_window_view(bits, window)
+        if starts is None:
+            starts = np.arange(n_windows)
+            windows = windows[:n_windows]
+        else:
+            windows = windows[starts]
+        count_prefix = np.concatenate(([0], np.cumsum(bits, dtype=np.int64)))
+        flips = (bits[1:] != bits[:-1]).astype(np.int64)
+        flip_prefix = np.concatenate(([0], np.cumsum(flips)))
+
+        count_a = count_prefix[starts + window] - count_prefix[starts]
+        transitions = flip_prefix[starts + window - 1] - flip_prefix[starts]
+        return self.fill(X, windows, count_a, transitions, hour)
+
+    def transform_buffer(self, buffer, hour):
+        # Features of the last window of a SequenceBuffer, counted with its prefix sums
+        window = self.window
+        X = np.empty((1, self.n_features))
+        return self.fill(X, buffer.bits(window), buffer.count('A', -window),
+                         buffer.transitions(-window), hour)
+
+    def every_window(self, hour, dtype=np.float64):
+        # Features of all 2^window windows, row i being the window encoded by i
+        # (first character in the most significant bit, A = 1)
+        window = self.window
+        shifts = np.arange(window - 1, -1, -1)
+        windows = ((np.arange(1 << window)[:, None] >> shifts) & 1).astype(np.uint8)
+        count_a = windows.sum(axis=1)
+        transitions = np.count_nonzero(windows[:, 1:] != windows[:, :-1], axis=1)
+        X = np.empty((len(windows), self.n_features), dtype=dtype)
+        return self.fill(X, windows, count_a, transitions, hour)
+
+    def fill(self, X, windows, count_a, transitions, hour):
+        window = self.window
+        X[:, :window] = windows
+        X[:, window] = count_a / window
+        X[:, window + 1] = self.entropies[count_a]
+        X[:, window + 2] = np.sin(2 * np.pi * hour / 24)
+        X[:, window + 3] = np.cos(2 * np.pi * hour / 24)
+        X[:, window + 4] = self.complexities[count_a, transitions]
+        return X
+
+    def training_data(self, sequence, hour):
+        # Every window that is followed by a character, labelled 1 if that character is 'A'
+        bits = to_bits(sequence)
+        n_windows = len(bits) - self.window
+        X = self.transform_bits(bits, hour, n_windows)
+        y = bits[self.window:self.window + len(X)].astype(np.int64)
+        return X, y
@@ -0,0 +1,22 @@
+# Read by gunicorn when started from this directory, e.g. `gunicorn app:app`.
+# Sessions, training jobs and journals live in the serving process, so requests
+# for one session must all reach the same worker: run one worker with threads.
+workers = 1
+worker_class = 'gthread'
+threads = 16
+bind = '127.0.0.1:5959'
+
+
+def on_starting(server):
+    if server.cfg.workers != 1:
+        # gunicorn prints RuntimeErrors raised here and exits
+        raise RuntimeError(f"The predictor API keeps its sessions in memory and must run a single worker, "
+                           f"got {server.cfg.workers}; raise `threads` instead")
+
+
+def post_worker_init(worker):
+    # Recover journaled sessions and preload before the worker accepts requests,
+    # rather than on the first one
+    services = getattr(worker.wsgi, 'extensions', {}).get('predictor_services')
+    if services is not None:
+        services.start()
@@ -0,0 +1,161 @@
+import bisect
+import math
+import threading
+
+
+# Minimal Prometheus text-format (0.0.4) metrics, enough for counters, gauges and histograms
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def label_key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}'
+                                for key, value in items]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def replace(self, samples):
+        # Swaps in every (value, labels) sample at once, so a concurrent scrape
+        # renders either the old or the new set, never a partly filled one
+        values = {self.label_key(labels): value for value, labels in samples}
+        with self.lock:
+            self.values = values
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            state['buckets'][index] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def render(self):
+        with self.lock:
+            items = sorted((key, {'buckets': list(state['buckets']), 'sum': state['sum'], 'count': state['count']})
+                           for key, state in self.values.items())
+
+        lines = self.header()
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state['buckets']):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, ('le', format_value(bound)))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {format_value(state["sum"])}')
+            lines.append(f'{self.name}_count{labels} {state["count"]}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    'http_requests_total', 'HTTP requests by endpoint and status code', ('endpoint', 'status')))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', 'HTTP request handling time', ('endpoint',)))
+TRAINING_PHASE_SECONDS = REGISTRY.register(Histogram(
+    'predictor_training_phase_seconds', 'Time spent in each /api/train phase', ('phase',)))
+TRAINING_JOBS = REGISTRY.register(Counter(
+    'predictor_training_jobs_total', 'Finished training jobs by status and model source', ('status', 'source')))
+METHOD_SECONDS = REGISTRY.register(Histogram(
+    'predictor_method_duration_seconds', 'Time spent in predictor methods', ('method',), buckets=FAST_BUCKETS))
+PDF_EXTRACTION_SECONDS = REGISTRY.register(Histogram(
+    'pdf_extraction_duration_seconds', 'Time spent parsing uploaded PDFs'))
+PDF_PAGES = REGISTRY.register(Counter(
+    'pdf_pages_total', 'PDF pages parsed'))
+PREDICTOR_MEMORY = REGISTRY.register(Gauge(
+    'predictor_memory_bytes', 'Estimated memory held by all live predictors, by component', ('component',)))
+ACTIVE_SESSIONS = REGISTRY.register(Gauge(
+    'predictor_active_sessions', 'Number of live predictor sessions'))
+STREAM_CONNECTIONS = REGISTRY.register(Gauge(
+    'predictor_stream_connections', 'Open streaming connections by channel', ('channel',)))
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from sequence_buffer import SequenceBuffer
+
+
+CACHE_FORMAT_VERSION = 1
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.model_cache')
+DEFAULT_CACHE_MAX_MB = 1024
+DEFAULT_MAX_TAIL = 500
+
+
+def sequence_digest(sequence):
+    return hashlib.sha256(sequence.encode('ascii', 'replace')).hexdigest()
+
+
+def params_digest(params):
+    payload = json.dumps({'version': CACHE_FORMAT_VERSION, 'params': params},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def directory_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class ModelCache:
+    # Content-addressed store of trained predictor states. Each entry is a
+    # directory named by hash(hyperparameters, sequence) holding the count tables
+    # as .npy files (memory-mapped copy-on-write on load), the fitted sklearn
+    # objects as a joblib pickle and a small meta.json. Entries are evicted least
+    # recently used first once the cache grows past max_bytes.
+
+    def __init__(self, root=None, max_bytes=None, max_tail=None):
+        if root is None:
+            root = os.environ.get('PREDICTOR_CACHE_DIR', DEFAULT_CACHE_DIR)
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('PREDICTOR_CACHE_MAX_MB', DEFAULT_CACHE_MAX_MB)) * 1024 * 1024
+        if max_tail is None:
+            max_tail = int(os.environ.get('PREDICTOR_CACHE_MAX_TAIL', DEFAULT_MAX_TAIL))
+
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_tail = max_tail
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'prefix_hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(self.root, exist_ok=True)
+
+    def entry_key(self, params_key, seq_key):
+        return hashlib.sha256(f'{params_key}:{seq_key}'.encode()).hexdigest()[:40]
+
+    def entry_path(self, key):
+        return os.path.join(self.root, key)
+
+    def entries(self):
+        metas = []
+        for entry in os.scandir(self.root):
+            meta_path = os.path.join(entry.path, 'meta.json')
+            if not entry.is_dir() or not os.path.exists(meta_path):
+                continue
+            try:
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                meta['last_access'] = os.path.getmtime(meta_path)
+                metas.append(meta)
+            except (OSError, ValueError):
+                continue
+        return metas
+
+    def load_or_train(self, predictor_cls, sequence, **kwargs):
+        # Returns (predictor, source) where source is 'hit', 'prefix' or 'trained'
+        template = predictor_cls(sequence, initialize=False, **kwargs)
+        params_key = params_digest(template.hyperparameters())
+
+        predictor = self.load(template, params_key, sequence)
+        if predictor is not None:
+            return predictor, 'hit'
+
+        predictor = self.load_prefix(predictor_cls, params_key, sequence, kwargs)
+        if predictor is not None:
+            return predictor, 'prefix'
+
+        self.stats['misses'] += 1
+        predictor = predictor_cls(sequence, **kwargs)
+        try:
+            self.store(predictor, params_key, sequence)
+        except OSError as e:
+            logging.warning(f"Could not write model cache entry: {str(e)}")
+        return predictor, 'trained'
+
+    def load(self, predictor, params_key, sequence):
+        key = self.entry_key(params_key, sequence_digest(sequence))
+        if not self.restore(predictor, key):
+            return None
+        self.stats['hits'] += 1
+        return predictor
+
+    def load_prefix(self, predictor_cls, params_key, sequence, kwargs):
+        # Reuse the longest cached prefix of sequence if the remaining tail is short
+        # enough, folding the tail in as live characters
+        candidates = [meta for meta in self.entries()
+                      if meta['params_key'] == params_key and
+                      0 < len(sequence) - meta['length'] <= self.max_tail]
+        for meta in sorted(candidates, key=lambda m: m['length'], reverse=True):
+            prefix = sequence[:meta['length']]
+            if sequence_digest(prefix) != meta['sequence_sha256']:
+                continue
+
+            predictor = predictor_cls(prefix, initialize=False, **kwargs)
+            if not self.restore(predictor, meta['key']):
+                continue
+            with predictor.training_phase('fold_cached_tail'):
+                for char in sequence[meta['length']:]:
+                    predictor.update_state(char)
+            # The tail is now part of the training sequence, so a refit must not add it again
+            predictor.sequence = SequenceBuffer.fixed(sequence)
+            predictor.chars_since_refit = 0
+            predictor.publish_snapshot()
+            self.stats['prefix_hits'] += 1
+            return predictor
+        return None
+
+    def restore(self, predictor, key):
+        path = self.entry_path(key)
+        meta_path = os.path.join(path, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+
+        try:
+            with predictor.training_phase('load_cached_model'):
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='c')
+                          for name in meta['arrays']}
+                import joblib
+                objects = joblib.load(os.path.join(path, 'objects.joblib'))
+                predictor.restore_components(arrays, objects)
+            os.utime(meta_path)
+        except Exception as e:
+            logging.warning(f"Discarding unreadable model cache entry {key}: {str(e)}")
+            shutil.rmtree(path, ignore_errors=True)
+            return False
+
+        elapsed = predictor.phase_timings['load_cached_model']
+        logging.info(f"Loaded cached model {key} in {elapsed * 1000:.1f} ms")
+        return True
+
+    def store(self, predictor, params_key, sequence):
+        seq_key = sequence_digest(sequence)
+        key = self.entry_key(params_key, seq_key)
+        path = self.entry_path(key)
+        if os.path.exists(path):
+            return key
+
+        arrays, objects = predictor.trained_state()
+        staging = tempfile.mkdtemp(prefix='.staging-', dir=self.root)
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(staging, f'{name}.npy'), np.asarray(array))
+            import joblib
+            joblib.dump(objects, os.path.join(staging, 'objects.joblib'))
+
+            meta = {
+                'key': key,
+                'params_key': params_key,
+                'sequence_sha256': seq_key,
+                'length': len(sequence),
+                'arrays': sorted(arrays),
+                'created': time.time()
+            }
+            meta['bytes'] = directory_size(staging)
+            with open(os.path.join(staging, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+
+            # Atomic publish; another worker may have stored the same entry meanwhile
+            try:
+                os.rename(staging, path)
+            except OSError:
+                shutil.rmtree(staging, ignore_errors=True)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        self.evict()
+        return key
+
+    def evict(self):
+        with self.lock:
+            metas = sorted(self.entries(), key=lambda m: m['last_access'])
+            total = sum(meta.get('bytes', 0) for meta in metas)
+            for meta in metas[:-1]:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(self.entry_path(meta['key']), ignore_errors=True)
+                total -= meta.get('bytes', 0)
+                self.stats['evictions'] += 1
+
+    def summary(self):
+        metas = self.entries()
+        return {
+            'entries': len(metas),
+            'total_bytes': sum(meta.get('bytes', 0) for meta in metas),
+            'max_bytes': self.max_bytes,
+            **self.stats
+        }
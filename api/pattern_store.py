@@ -0,0 +1,108 @@
+import numpy as np
+
+from sequence_buffer import to_bits
+
+
+# Column of each next character in a count table row
+COLUMNS = {'A': 0, 'B': 1}
+
+
+def decode_pattern(code, length):
+    # First character is in the most significant bit of code
+    return ''.join('A' if (code >> (length - 1 - i)) & 1 else 'B' for i in range(length))
+
+
+def window_codes(bits, length):
+    # codes[i] encodes bits[i:i + length]
+    n = len(bits) - length + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.int64)
+    codes = np.zeros(n, dtype=np.int64)
+    for offset in range(length):
+        codes = (codes << 1) | bits[offset:offset + n]
+    return codes
+
+
+class PatternTable:
+    # Dense next-character counts for every binary pattern of each length in
+    # [min_length, max_length]: one (2^L, 2) int32 array per length, indexed by
+    # the integer encoding of the pattern.
+
+    def __init__(self, min_length, max_length):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.counts = {length: np.zeros((1 << length, 2), dtype=np.int32)
+                       for length in range(min_length, max_length + 1)}
+
+    @property
+    def nbytes(self):
+        return sum(table.nbytes for table in self.counts.values())
+
+    def build(self, sequence, executor=None, chunks=1, chunk_size=None):
+        # With an executor the sequence is split into `chunks` ranges of window
+        # start positions that are counted concurrently and summed. chunk_size
+        # counts at most that many windows at a time instead, which bounds the
+        # temporary code arrays on long sequences.
+        bits = to_bits(sequence)
+        for length in self.counts:
+            self.counts[length] = np.zeros_like(self.counts[length])
+
+        if chunk_size is not None:
+            for start in range(0, len(bits), max(chunk_size, 1)):
+                self.merge(self.count_range(bits, start, min(start + chunk_size, len(bits))))
+        elif executor is None or chunks <= 1 or len(bits) < chunks * (self.max_length + 1):
+            self.merge(self.count_range(bits, 0, len(bits)))
+        else:
+            step = -(-len(bits) // chunks)
+            futures = [executor.submit(self.count_range, bits, start, min(start + step, len(bits)))
+                       for start in range(0, len(bits), step)]
+            for future in futures:
+                self.merge(future.result())
+        return self
+
+    def merge(self, partial):
+        for length, table in partial.items():
+            self.counts[length] += table
+
+    def count_range(self, bits, start, stop):
+        # Counts for the windows starting in [start, stop), as {length: table}
+        segment = bits[start:stop + self.max_length].astype(np.int64)
+        next_cols = 1 - segment
+        codes = segment
+        tables = {}
+
+        # Rolling hash: codes of length L windows are the length L - 1 codes
+        # shifted left with the following bit appended
+        for length in range(1, self.max_length + 1):
+            if length > 1:
+                n = len(segment) - length + 1
+                if n <= 0:
+                    break
+                codes = (codes[:n] << 1) | segment[length - 1:]
+
+            if length < self.min_length:
+                continue
+            occurrences = min(stop - start, len(segment) - length)
+            if occurrences <= 0:
+                break
+            index = codes[:occurrences] * 2 + next_cols[length:length + occurrences]
+            tables[length] = np.bincount(
+                index, minlength=2 << length).reshape(-1, 2).astype(np.int32)
+        return tables
+
+    def add_code(self, code, length, next_char):
+        # Count next_char after every suffix, within the length range, of the
+        # window of `length` characters given by its encoding
+        col = COLUMNS.get(next_char, 1)
+        for suffix in range(self.min_length, min(self.max_length, length) + 1):
+            self.counts[suffix][code & ((1 << suffix) - 1), col] += 1
+
+    def get_code(self, length, code):
+        # Returns [count_a, count_b]
+        table = self.counts.get(length)
+        if table is None:
+            return np.zeros(2, dtype=np.int32)
+        return table[code]
+
+    def get_codes(self, length, codes):
+        return self.counts[length][codes]
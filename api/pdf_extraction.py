@@ -0,0 +1,208 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+
+DEFAULT_MAX_BYTES_MB = 50
+DEFAULT_MAX_PAGES = 2000
+DEFAULT_PARALLEL_MIN_PAGES = 64
+DEFAULT_CACHE_ENTRIES = 128
+DEFAULT_MAX_FILES = 20
+CHUNK_SIZE = 1 << 20
+# Room for the multipart boundaries, headers and form fields of an upload
+REQUEST_OVERHEAD_BYTES = 1 << 20
+
+AB_PATTERN = re.compile(r'[AB]')
+
+
+class PDFLimitError(ValueError):
+    pass
+
+
+def max_request_bytes():
+    # Largest upload request worth receiving: every allowed file at the size limit.
+    # Werkzeug buffers the whole multipart body before PDFExtractor sees a file.
+    max_bytes = int(os.environ.get('PDF_MAX_MB', DEFAULT_MAX_BYTES_MB)) * 1024 * 1024
+    max_files = int(os.environ.get('PDF_MAX_FILES', DEFAULT_MAX_FILES))
+    return max_bytes * max_files + REQUEST_OVERHEAD_BYTES
+
+
+# Helper function to extract only 'A' and 'B' characters from text
+def extract_a_and_b(text):
+    return ''.join(AB_PATTERN.findall(text))
+
+
+def extract_page_range(path, start, stop):
+    # Runs in a worker process: A/B characters of pages [start, stop), one string per page
+    import PyPDF2
+    reader = PyPDF2.PdfReader(path)
+    return [extract_a_and_b(reader.pages[i].extract_text() or '') for i in range(start, stop)]
+
+
+def spool_upload(stream, max_bytes):
+    # Copies an upload stream to a temporary file, hashing it on the way.
+    # Returns (path, sha256, size); the caller removes the file.
+    digest = hashlib.sha256()
+    size = 0
+    spooled = tempfile.NamedTemporaryFile(prefix='upload-', suffix='.pdf', delete=False)
+    try:
+        with spooled:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise PDFLimitError(f"File exceeds the {max_bytes // (1024 * 1024)} MB upload limit")
+                digest.update(chunk)
+                spooled.write(chunk)
+    except BaseException:
+        os.unlink(spooled.name)
+        raise
+    return spooled.name, digest.hexdigest(), size
+
+
+class PDFExtractor:
+    # Extracts the A/B characters of an uploaded PDF page by page. Uploads are
+    # spooled to disk, large documents are spread over a process pool and
+    # results are cached by file hash so re-uploads are free.
+
+    def __init__(self, max_bytes=None, max_pages=None, parallel_min_pages=None, workers=None,
+                 cache_entries=None, max_files=None):
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('PDF_MAX_MB', DEFAULT_MAX_BYTES_MB)) * 1024 * 1024
+        if max_pages is None:
+            max_pages = int(os.environ.get('PDF_MAX_PAGES', DEFAULT_MAX_PAGES))
+        if parallel_min_pages is None:
+            parallel_min_pages = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', DEFAULT_PARALLEL_MIN_PAGES))
+        if workers is None:
+            workers = int(os.environ.get('PDF_WORKERS', os.cpu_count() or 1))
+        if cache_entries is None:
+            cache_entries = int(os.environ.get('PDF_CACHE_ENTRIES', DEFAULT_CACHE_ENTRIES))
+        if max_files is None:
+            max_files = int(os.environ.get('PDF_MAX_FILES', DEFAULT_MAX_FILES))
+
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self.parallel_min_pages = parallel_min_pages
+        self.workers = max(1, workers)
+        self.cache_entries = cache_entries
+        self.max_files = max_files
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def get_pool(self):
+        # Spawned rather than forked: the API process runs threads
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context('spawn'))
+            return self.pool
+
+    def cached(self, digest):
+        with self.lock:
+            result = self.cache.get(digest)
+            if result is not None:
+                self.cache.move_to_end(digest)
+            return result
+
+    def remember(self, digest, result):
+        if self.cache_entries <= 0:
+            return
+        with self.lock:
+            self.cache[digest] = result
+            self.cache.move_to_end(digest)
+            while len(self.cache) > self.cache_entries:
+                self.cache.popitem(last=False)
+
+    def extract(self, stream):
+        # Returns (characters in document order, info)
+        return self.extract_spooled([spool_upload(stream, self.max_bytes)])[0]
+
+    def spool_many(self, streams):
+        # Spools several uploads up front, e.g. while the request body is still readable
+        if len(streams) > self.max_files:
+            raise PDFLimitError(f"{len(streams)} files uploaded, the limit is {self.max_files}")
+        spooled = []
+        try:
+            for stream in streams:
+                spooled.append(spool_upload(stream, self.max_bytes))
+        except BaseException:
+            for path, _, _ in spooled:
+                os.unlink(path)
+            raise
+        return spooled
+
+    def extract_spooled(self, spooled):
+        # [(characters, info)] for spooled uploads, in the order given; removes the files.
+        # Documents that are not cached are parsed concurrently.
+        try:
+            results = [None] * len(spooled)
+            pending = []
+            for index, (path, digest, size) in enumerate(spooled):
+                result = self.cached(digest)
+                if result is not None:
+                    text, pages = result
+                    results[index] = (text, {'sha256': digest, 'bytes': size, 'pages': pages, 'cached': True})
+                else:
+                    pending.append(index)
+
+            # One document on its own is parsed here unless it is large enough to split
+            texts = self.extract_files([spooled[index][0] for index in pending], alone=len(pending) == 1)
+            for index, (text, pages) in zip(pending, texts):
+                _, digest, size = spooled[index]
+                self.remember(digest, (text, pages))
+                results[index] = (text, {'sha256': digest, 'bytes': size, 'pages': pages, 'cached': False})
+            return results
+        finally:
+            for path, _, _ in spooled:
+                os.unlink(path)
+
+    def page_count(self, path):
+        import PyPDF2
+        page_count = len(PyPDF2.PdfReader(path).pages)
+        if page_count > self.max_pages:
+            raise PDFLimitError(f"PDF has {page_count} pages, the limit is {self.max_pages}")
+        return page_count
+
+    def extract_files(self, paths, alone=False):
+        # [(characters, pages)] per file. Large documents are split into contiguous
+        # page ranges, a couple per worker; with several documents the small ones go
+        # to the pool whole, so every file is parsed at the same time.
+        if not paths:
+            return []
+        page_counts = [self.page_count(path) for path in paths]
+        if self.workers == 1 or (alone and page_counts[0] < self.parallel_min_pages):
+            import PyPDF2
+            results = []
+            for path, page_count in zip(paths, page_counts):
+                reader = PyPDF2.PdfReader(path)
+                results.append((''.join(extract_a_and_b(page.extract_text() or '') for page in reader.pages),
+                                page_count))
+            return results
+
+        pool = self.get_pool()
+        futures = []
+        for path, page_count in zip(paths, page_counts):
+            if page_count < self.parallel_min_pages:
+                ranges = [(0, page_count)]
+            else:
+                chunk = max(1, -(-page_count // (self.workers * 2)))
+                ranges = [(start, min(start + chunk, page_count)) for start in range(0, page_count, chunk)]
+            futures.append([pool.submit(extract_page_range, path, start, stop) for start, stop in ranges])
+            logging.debug(f"Extracting {page_count} pages in {len(ranges)} chunks")
+
+        results = []
+        for file_futures, page_count in zip(futures, page_counts):
+            parts = []
+            for future in file_futures:
+                parts.extend(future.result())
+            results.append((''.join(parts), page_count))
+        return results
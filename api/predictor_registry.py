@@ -0,0 +1,199 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+DEFAULT_MEMORY_BUDGET_MB = 2048
+DEFAULT_IDLE_TTL_SECONDS = 3600
+# Node arrays of a fitted sklearn Tree
+TREE_ARRAYS = ('children_left', 'children_right', 'feature', 'threshold', 'impurity', 'n_node_samples',
+               'weighted_n_node_samples', 'value')
+
+
+def deep_sizeof(obj, seen=None):
+    # Rough recursive size of plain containers and numpy arrays
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, np.ndarray):
+        return sys.getsizeof(obj) + (obj.nbytes if obj.base is None else 0)
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)) or hasattr(obj, 'maxlen'):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+def model_sizeof(model):
+    # Fitted sklearn estimators: their attributes, plus the node arrays of every
+    # tree of an ensemble, which deep_sizeof cannot see
+    if not hasattr(model, '__dict__'):
+        return sys.getsizeof(model)
+    size = deep_sizeof(vars(model))
+    for estimator in np.ravel(getattr(model, 'estimators_', ())):
+        tree = getattr(estimator, 'tree_', None)
+        if tree is not None:
+            size += sum(getattr(tree, name).nbytes for name in TREE_ARRAYS)
+    return size
+
+
+class SessionEntry:
+    def __init__(self, session_id, predictor, pinned=False):
+        self.session_id = session_id
+        self.predictor = predictor
+        # Pinned sessions (e.g. a preloaded default model) are never evicted
+        self.pinned = pinned
+        self.created_at = time.time()
+        self.last_access = self.created_at
+        self.memory = predictor.memory_usage()
+
+    @property
+    def memory_bytes(self):
+        return sum(self.memory.values())
+
+    def refresh_memory(self):
+        self.memory = self.predictor.memory_usage()
+
+
+class PredictorRegistry:
+    def __init__(self, memory_budget_bytes=None, idle_ttl=None, on_release=None):
+        if memory_budget_bytes is None:
+            memory_budget_bytes = int(os.environ.get(
+                'PREDICTOR_MEMORY_BUDGET_MB', DEFAULT_MEMORY_BUDGET_MB)) * 1024 * 1024
+        if idle_ttl is None:
+            idle_ttl = float(os.environ.get('PREDICTOR_IDLE_TTL', DEFAULT_IDLE_TTL_SECONDS))
+
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_ttl = idle_ttl
+        # Called as on_release(session_id, predictor) when a session is removed or evicted
+        self.on_release = on_release
+        self.sessions = OrderedDict()
+        self.evictions = {'lru': 0, 'idle': 0}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        with self.lock:
+            return session_id in self.sessions
+
+    def get(self, session_id):
+        with self.lock:
+            self.evict_idle()
+            entry = self.sessions.get(session_id)
+            if entry is None:
+                return None
+            entry.last_access = time.time()
+            self.sessions.move_to_end(session_id)
+            return entry.predictor
+
+    def peek(self, session_id):
+        # Like get, but does not count as activity for LRU / idle eviction
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            return entry.predictor if entry is not None else None
+
+    def put(self, session_id, predictor, pinned=False):
+        entry = SessionEntry(session_id, predictor, pinned)
+
+        with self.lock:
+            # A replaced predictor may still be serving in-flight requests, so it is
+            # left to the garbage collector rather than released here
+            self.sessions.pop(session_id, None)
+            self.sessions[session_id] = entry
+            self.evict_idle()
+            self.evict_over_budget(keep=session_id)
+
+        logging.info(f"Session {session_id} registered ({entry.memory_bytes / 1024:.1f} KiB), "
+                     f"{len(self.sessions)} active")
+        return predictor
+
+    def remove(self, session_id):
+        with self.lock:
+            entry = self.sessions.pop(session_id, None)
+        if entry is None:
+            return False
+        self.release(entry)
+        return True
+
+    def total_memory(self):
+        with self.lock:
+            return sum(entry.memory_bytes for entry in self.sessions.values())
+
+    def evict_idle(self):
+        if self.idle_ttl <= 0:
+            return
+        now = time.time()
+        expired = [sid for sid, entry in self.sessions.items()
+                   if not entry.pinned and now - entry.last_access > self.idle_ttl]
+        for session_id in expired:
+            self.release(self.sessions.pop(session_id))
+            self.evictions['idle'] += 1
+            logging.info(f"Session {session_id} evicted after {self.idle_ttl:.0f}s idle")
+
+    def evict_over_budget(self, keep=None):
+        total = sum(entry.memory_bytes for entry in self.sessions.values())
+        for session_id in list(self.sessions):
+            if total <= self.memory_budget_bytes:
+                break
+            if session_id == keep or self.sessions[session_id].pinned:
+                continue
+            entry = self.sessions.pop(session_id)
+            total -= entry.memory_bytes
+            self.release(entry)
+            self.evictions['lru'] += 1
+            logging.info(f"Session {session_id} evicted to stay within memory budget")
+
+    def release(self, entry):
+        executor = getattr(entry.predictor, 'executor', None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+        if self.on_release is not None:
+            try:
+                self.on_release(entry.session_id, entry.predictor)
+            except Exception as e:
+                logging.error(f"Releasing session {entry.session_id} failed: {str(e)}")
+
+    def stats(self, refresh=False):
+        with self.lock:
+            entries = list(self.sessions.values())
+            evictions = dict(self.evictions)
+        if refresh:
+            # Outside the lock, as each measurement waits for its session's update queue
+            for entry in entries:
+                entry.refresh_memory()
+
+        now = time.time()
+        sessions = {}
+        for entry in entries:
+            snapshot = entry.predictor.snapshot
+            sessions[entry.session_id] = {
+                'memory_bytes': entry.memory_bytes,
+                'memory_breakdown': dict(entry.memory),
+                'sequence_length': snapshot.sequence_length,
+                'predictions': snapshot.prediction_count,
+                'state': snapshot.prediction_state,
+                'pinned': entry.pinned,
+                'age_seconds': round(now - entry.created_at, 3),
+                'idle_seconds': round(now - entry.last_access, 3)
+            }
+
+        return {
+            'active_sessions': len(sessions),
+            'total_memory_bytes': sum(s['memory_bytes'] for s in sessions.values()),
+            'memory_budget_bytes': self.memory_budget_bytes,
+            'idle_ttl_seconds': self.idle_ttl,
+            'evictions': evictions,
+            'sessions': sessions
+        }
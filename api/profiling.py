@@ -0,0 +1,73 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+
+
+class RequestProfiler:
+    # Profiles the next N requests under cProfile and aggregates their stats.
+    # Only one request is profiled at a time; concurrent requests are not sampled.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = threading.Lock()
+        self.remaining = 0
+        self.sampled = 0
+        self.started_at = None
+        self.stats = None
+
+    def start(self, requests):
+        with self.lock:
+            self.remaining = requests
+            self.sampled = 0
+            self.started_at = time.time()
+            self.stats = None
+
+    def stop(self):
+        with self.lock:
+            self.remaining = 0
+
+    def begin(self):
+        # Returns a running profiler if this request is sampled, otherwise None
+        with self.lock:
+            if self.remaining <= 0 or not self.active.acquire(blocking=False):
+                return None
+            self.remaining -= 1
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this interpreter
+            self.active.release()
+            return None
+        return profiler
+
+    def end(self, profiler):
+        profiler.disable()
+        try:
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profiler)
+                else:
+                    self.stats.add(profiler)
+                self.sampled += 1
+        finally:
+            self.active.release()
+
+    def report(self, sort='cumulative', limit=50):
+        with self.lock:
+            text = ''
+            if self.stats is not None:
+                out = io.StringIO()
+                self.stats.stream = out
+                self.stats.sort_stats(sort).print_stats(limit)
+                text = out.getvalue()
+            return {
+                'active': self.remaining > 0,
+                'remaining': self.remaining,
+                'sampled': self.sampled,
+                'started_at': self.started_at,
+                'stats': text
+            }
@@ -0,0 +1,35 @@
+from collections import deque
+
+
+class RollingAccuracy:
+    # Correct/total counts over the last `window` outcomes, overall and per key.
+    # Adding an outcome is O(1): the one falling out of the window is subtracted.
+
+    def __init__(self, window):
+        self.window = window
+        self.outcomes = deque(maxlen=window)
+        self.counts = {}
+        self.correct = 0
+
+    def __len__(self):
+        return len(self.outcomes)
+
+    def add(self, key, correct):
+        correct = int(bool(correct))
+        if len(self.outcomes) == self.window:
+            old_key, old_correct = self.outcomes[0]
+            self.counts[old_key][0] -= old_correct
+            self.counts[old_key][1] -= 1
+            self.correct -= old_correct
+
+        self.outcomes.append((key, correct))
+        counts = self.counts.setdefault(key, [0, 0])
+        counts[0] += correct
+        counts[1] += 1
+        self.correct += correct
+
+    def accuracy(self, key=None):
+        if key is None:
+            return self.correct / len(self.outcomes) if self.outcomes else 0
+        correct, total = self.counts.get(key, (0, 0))
+        return correct / total if total > 0 else 0
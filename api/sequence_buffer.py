@@ -0,0 +1,192 @@
+import numpy as np
+
+
+# Character of each bit value, indexed by bit
+LETTERS = np.frombuffer(b'BA', dtype=np.uint8)
+# Bits of the rolling tail code, see SequenceBuffer.tail_code
+CODE_BITS = 62
+
+
+def to_bits(sequence):
+    # 'A' -> 1, 'B' -> 0, same convention as BatchFeatureExtractor. Any other
+    # character is an error. Bit arrays and buffers are returned as they are,
+    # without copying.
+    if isinstance(sequence, np.ndarray):
+        return sequence
+    if isinstance(sequence, SequenceBuffer):
+        return sequence.bits()
+    raw = np.frombuffer(str(sequence).encode('ascii', 'replace'), dtype=np.uint8)
+    bits = raw == ord('A')
+    if np.count_nonzero(bits) + np.count_nonzero(raw == ord('B')) != len(raw):
+        raise ValueError("Sequence must only contain 'A' and 'B' characters")
+    return bits.view(np.uint8)
+
+
+class SequenceBuffer:
+    # Bounded rolling A/B sequence, one uint8 per character (A = 1). Keeps the most
+    # recent `capacity` characters in preallocated storage with `spare` extra
+    # slots, so appends are amortised O(1) and windows are numpy views. Prefix
+    # sums of A's and of transitions are extended lazily on the first query after
+    # an append, which makes counts over any range O(1). They are stored modulo
+    # 2^16 when the capacity allows: differences over a range of at most
+    # `capacity` characters are still exact.
+
+    def __init__(self, sequence='', capacity=10000, spare=None):
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.data = np.zeros(capacity + (capacity if spare is None else spare), dtype=np.uint8)
+        self.start = 0
+        self.end = 0
+        self.total_appended = 0
+        self.prefix_dtype = np.uint16 if capacity < (1 << 16) else np.uint32
+        self.a_prefix = None
+        self.flip_prefix = None
+        self.prefix_end = 0
+        self.code = 0
+        self.extend(sequence)
+
+    @classmethod
+    def fixed(cls, sequence):
+        # Buffer sized exactly to a sequence that will not grow, e.g. a training set
+        bits = to_bits(sequence)
+        return cls(bits, capacity=max(1, len(bits)), spare=0)
+
+    @property
+    def nbytes(self):
+        prefix = 0 if self.a_prefix is None else self.a_prefix.nbytes + self.flip_prefix.nbytes
+        return self.data.nbytes + prefix
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __str__(self):
+        return LETTERS[self.bits()].tobytes().decode('ascii')
+
+    def __repr__(self):
+        return f"SequenceBuffer(len={len(self)}, capacity={self.capacity})"
+
+    def __iter__(self):
+        return iter(str(self))
+
+    def __eq__(self, other):
+        if isinstance(other, SequenceBuffer):
+            other = str(other)
+        return str(self) == other
+
+    def __bool__(self):
+        return self.end > self.start
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return LETTERS[self.bits()[key]].tobytes().decode('ascii')
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("SequenceBuffer index out of range")
+        return 'A' if self.data[self.start + key] else 'B'
+
+    def bits(self, n=None):
+        # View of the last n characters (all of them by default) as 0/1
+        if n is None:
+            return self.data[self.start:self.end]
+        if n <= 0:
+            return self.data[:0]
+        return self.data[max(self.start, self.end - n):self.end]
+
+    def reversed(self):
+        return self.bits()[::-1]
+
+    def tail_code(self, n):
+        # Integer encoding of the last n characters, first one in the most significant bit
+        n = min(n, len(self))
+        if n <= CODE_BITS:
+            return self.code & ((1 << n) - 1)
+        code = 0
+        for bit in self.bits(n).tolist():
+            code = (code << 1) | bit
+        return code
+
+    def compact(self, keep):
+        # Move the last `keep` characters to the front of the storage
+        self.data[0:keep] = self.data[self.end - keep:self.end]
+        self.start, self.end = 0, keep
+        self.prefix_end = 0
+
+    def append(self, char):
+        if char != 'A' and char != 'B':
+            raise ValueError(f"Sequence must only contain 'A' and 'B' characters, got {char!r}")
+        if self.end == len(self.data):
+            self.compact(self.capacity - 1)
+        elif self.end - self.start == self.capacity:
+            self.start += 1
+
+        bit = int(char == 'A')
+        self.data[self.end] = bit
+        self.code = ((self.code << 1) | bit) & ((1 << CODE_BITS) - 1)
+        self.end += 1
+        self.total_appended += 1
+
+    def extend(self, sequence):
+        bits = to_bits(sequence)[-self.capacity:]
+        n = len(bits)
+        if n == 0:
+            return
+        if self.end + n > len(self.data):
+            self.compact(min(len(self), self.capacity - n))
+        self.data[self.end:self.end + n] = bits
+        self.end += n
+        self.start = max(self.start, self.end - self.capacity)
+        self.total_appended += n
+        for bit in bits[-CODE_BITS:].tolist():
+            self.code = ((self.code << 1) | bit) & ((1 << CODE_BITS) - 1)
+
+    def update_prefix(self):
+        # a_prefix[i]: A's in data[:i]; flip_prefix[i]: positions 0 < j < i where data[j] != data[j - 1]
+        if self.a_prefix is None:
+            self.a_prefix = np.zeros(len(self.data) + 1, dtype=self.prefix_dtype)
+            self.flip_prefix = np.zeros(len(self.data) + 1, dtype=self.prefix_dtype)
+        lo, hi = self.prefix_end, self.end
+        if lo >= hi:
+            return
+        np.cumsum(self.data[lo:hi], dtype=self.prefix_dtype, out=self.a_prefix[lo + 1:hi + 1])
+        self.a_prefix[lo + 1:hi + 1] += self.a_prefix[lo]
+
+        first = max(lo, 1)
+        if first < hi:
+            flips = self.data[first:hi] != self.data[first - 1:hi - 1]
+            np.cumsum(flips, dtype=self.prefix_dtype, out=self.flip_prefix[first + 1:hi + 1])
+            self.flip_prefix[first + 1:hi + 1] += self.flip_prefix[first]
+        self.prefix_end = hi
+
+    def prefix_difference(self, prefix, lo, hi):
+        return (int(prefix[hi]) - int(prefix[lo])) % (1 << (8 * prefix.itemsize))
+
+    def bounds(self, start, stop):
+        start, stop, _ = slice(start, stop).indices(len(self))
+        return self.start + start, self.start + max(start, stop)
+
+    def count(self, char, start=None, stop=None):
+        # Occurrences of char in self[start:stop], O(1) once the prefix sums are current.
+        # Whole-buffer counts are a single pass instead, so a buffer that is only
+        # counted once (a training set) never allocates the prefix sums.
+        lo, hi = self.bounds(start, stop)
+        if start is None and stop is None:
+            count_a = int(np.count_nonzero(self.data[lo:hi]))
+        else:
+            self.update_prefix()
+            count_a = self.prefix_difference(self.a_prefix, lo, hi)
+        if char == 'A':
+            return count_a
+        return hi - lo - count_a if char == 'B' else 0
+
+    def transitions(self, start=None, stop=None):
+        # Number of adjacent pairs in self[start:stop] with different characters
+        lo, hi = self.bounds(start, stop)
+        if hi - lo < 2:
+            return 0
+        if start is None and stop is None:
+            return int(np.count_nonzero(self.data[lo + 1:hi] != self.data[lo:hi - 1]))
+        self.update_prefix()
+        return self.prefix_difference(self.flip_prefix, lo + 1, hi)
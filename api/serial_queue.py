@@ -0,0 +1,90 @@
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+DEFAULT_HANDOFF_WORKERS = 4
+
+handoff_executor = None
+handoff_lock = threading.Lock()
+
+
+def get_handoff_executor():
+    global handoff_executor
+    with handoff_lock:
+        if handoff_executor is None:
+            handoff_executor = ThreadPoolExecutor(max_workers=DEFAULT_HANDOFF_WORKERS,
+                                                  thread_name_prefix='serial-queue')
+        return handoff_executor
+
+
+class SerialQueue:
+    # Runs submitted calls one at a time, in submission order (an actor mailbox).
+    # The thread that finds the queue idle runs its own call inline, so an
+    # uncontended update costs no thread switch. Once that caller's work is done
+    # the queue is handed to the next caller blocked in call(), which drains it
+    # up to its own call. Only calls nobody waits for (submit) are left to a
+    # shared pool thread, which hands the queue on as soon as a caller blocks.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.running = False
+
+    def submit(self, fn, *args):
+        return self.enqueue(fn, args, None)
+
+    def call(self, fn, *args):
+        # Must not be used from inside a queued call, which would wait on itself
+        waiter = threading.Event()
+        future = self.enqueue(fn, args, waiter)
+        if not future.done():
+            # Set once the call has run, or when the queue is handed to this caller
+            waiter.wait()
+            if not future.done():
+                self.run(until=future)
+        return future.result()
+
+    def enqueue(self, fn, args, waiter):
+        future = Future()
+        with self.lock:
+            self.pending.append((future, fn, args, waiter))
+            if self.running:
+                return future
+            self.running = True
+        self.run(until=future)
+        return future
+
+    def handoff(self):
+        # The first pending call with a blocked caller, which then runs the queue
+        for _, _, _, waiter in self.pending:
+            if waiter is not None:
+                return waiter
+        return None
+
+    def run(self, until=None):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.running = False
+                    return
+                if until is None or until.done():
+                    waiter = self.handoff()
+                    if waiter is not None:
+                        waiter.set()
+                        return
+                    if until is not None:
+                        get_handoff_executor().submit(self.run)
+                        return
+                future, fn, args, waiter = self.pending.popleft()
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            if waiter is not None:
+                waiter.set()
+
+    def __len__(self):
+        return len(self.pending)
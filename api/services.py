@@ -0,0 +1,170 @@
+import logging
+import threading
+
+import metrics
+
+
+DEFAULT_SESSION_ID = 'default'
+
+
+def lazy_service(factory):
+    # Property that builds the service (and imports its dependencies) on first access
+    name = factory.__name__
+
+    def getter(self):
+        instance = self.instances.get(name)
+        if instance is None:
+            with self.lock:
+                instance = self.instances.get(name)
+                if instance is None:
+                    instance = self.instances[name] = factory(self)
+        return instance
+
+    return property(getter, doc=factory.__doc__)
+
+
+def format_prediction(prediction, last_char):
+    predicted_char, confidence, method = prediction  # Unpack the result
+
+    # Confidence threshold logic to determine the response message and color
+    confidence_pct = confidence * 100
+    if confidence_pct >= 80 and predicted_char == last_char:
+        if predicted_char == 'A':
+            message = "Next Character = 'A'"
+            color = "green"
+        else:
+            message = "Next Character = 'B'"
+            color = "blue"
+    else:
+        message = "Wait for next character."
+        color = "red"
+
+    return {"message": message, "color": color}
+
+
+def record_training_job(job):
+    metrics.TRAINING_JOBS.inc(status=job.status, source=job.source or 'none')
+
+
+def observe_method(name, seconds):
+    metrics.METHOD_SECONDS.observe(seconds, method=name)
+
+
+def observe_training_phase(job):
+    def callback(phase, seconds):
+        job.record_phase(phase, seconds)
+        metrics.TRAINING_PHASE_SECONDS.observe(seconds, phase=phase)
+    return callback
+
+
+class Services:
+    # Shared state of one API app. Services are created lazily so a worker that
+    # only parses PDFs never imports sklearn, and one that only predicts never
+    # imports PyPDF2.
+
+    def __init__(self, preload_file=None):
+        self.instances = {}
+        self.lock = threading.RLock()
+        # Sequence file trained (or loaded from the model cache) by start
+        self.preload_file = preload_file
+        self.recovered = False
+        self.started = False
+
+        # Samples requests under cProfile when switched on through /admin/profile
+        from profiling import RequestProfiler
+        self.request_profiler = RequestProfiler()
+
+    def loaded(self):
+        return sorted(self.instances)
+
+    @lazy_service
+    def predictor_class(self):
+        from EnhancedGamePredictor import EnhancedGamePredictor
+        return EnhancedGamePredictor
+
+    @lazy_service
+    def registry(self):
+        # One predictor per client session, evicted by LRU / idle TTL
+        from predictor_registry import PredictorRegistry
+        return PredictorRegistry(on_release=self.release_session)
+
+    @lazy_service
+    def session_store(self):
+        # Per-session journals and snapshots for crash recovery, on when PREDICTOR_JOURNAL_DIR is set
+        from session_journal import SessionStore
+        return SessionStore()
+
+    @lazy_service
+    def model_cache(self):
+        # Trained models on disk, keyed by sequence and hyperparameters
+        from model_cache import ModelCache
+        return ModelCache()
+
+    @lazy_service
+    def training_jobs(self):
+        # Background training; /api/predict keeps using the previous model until a job finishes
+        from training_jobs import TrainingJobManager
+        return TrainingJobManager(on_finished=record_training_job)
+
+    @lazy_service
+    def pdf_extractor(self):
+        # Page-level PDF parsing with an upload-hash result cache
+        from pdf_extraction import PDFExtractor
+        return PDFExtractor()
+
+    def publish(self, session_id, predictor, pinned=False):
+        # Registers a newly trained predictor and starts journaling it
+        predictor.observer = observe_method
+        try:
+            self.session_store.attach(session_id, predictor)
+        except Exception as e:
+            logging.error(f"Could not start a journal for session {session_id}: {str(e)}")
+        self.registry.put(session_id, predictor, pinned=pinned)
+
+    def release_session(self, session_id, predictor):
+        if 'session_store' in self.instances:
+            self.session_store.detach(session_id, predictor)
+
+    def start(self):
+        # Recovers journaled sessions and preloads the default model, once per
+        # process. Servers call it before serving rather than at import, so
+        # processes that only import the app (the spawned PDF workers, the debug
+        # reloader's parent) neither train nor touch the journals. Concurrent
+        # callers wait until it has finished; after a failure the next call retries
+        # the steps that did not complete.
+        if self.started:
+            return
+        with self.lock:
+            if self.started:
+                return
+            if not self.recovered:
+                self.recover_sessions()
+                self.recovered = True
+            if self.preload_file:
+                self.preload(self.preload_file)
+            self.started = True
+
+    def recover_sessions(self):
+        # Rebuilds the sessions journaled by a previous process, without retraining
+        if not self.session_store.enabled:
+            return 0
+        recovered = 0
+        for session_id, predictor in self.session_store.recover(self.predictor_class):
+            predictor.observer = observe_method
+            self.registry.put(session_id, predictor)
+            recovered += 1
+        if recovered:
+            logging.info(f"Recovered {recovered} sessions from {self.session_store.root}")
+        return recovered
+
+    def preload(self, path, session_id=DEFAULT_SESSION_ID):
+        # Train (or load from the model cache) a pinned model for the session
+        with open(path) as f:
+            sequence = ''.join(c for c in f.read().upper() if c in 'AB')
+        if not sequence:
+            raise ValueError(f"No A/B characters found in {path}")
+
+        predictor, source = self.model_cache.load_or_train(self.predictor_class, sequence)
+        self.publish(session_id, predictor, pinned=True)
+        logging.info(f"Preloaded model for session {session_id} from {path} ({source})")
+        return predictor
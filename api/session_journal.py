@@ -0,0 +1,320 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import re
+import shutil
+import struct
+import threading
+import time
+from collections import namedtuple
+
+
+DEFAULT_SNAPSHOT_INTERVAL = 1000
+
+METHODS = ('ensemble', 'markov', 'pattern', 'bayesian', 'cycle')
+STATES = ('PREDICTING', 'WAITING')
+WEIGHTS = ('rf', 'gb', 'online')
+
+# Journal records, little endian, each starting with its kind byte:
+#   prediction: input char, hour, predicted char, method, state after it, confidence
+#   reanalysis: whether errors were analysed, published ensemble weights (NaN when absent)
+PREDICTION, REANALYSIS = 1, 2
+RECORD_FORMATS = {
+    PREDICTION: struct.Struct('<BcBcBBf'),
+    REANALYSIS: struct.Struct('<BB3d')
+}
+
+PredictionRecord = namedtuple('PredictionRecord', ['kind', 'char', 'hour', 'predicted', 'method', 'state',
+                                                   'confidence'])
+ReanalysisRecord = namedtuple('ReanalysisRecord', ['kind', 'analyze_errors', 'ensemble_weights'])
+
+SNAPSHOT_FILE = re.compile(r'^snapshot-(\d+)\.pkl$')
+SESSION_DIR = re.compile(r'^[0-9a-f]{32}$')
+LOCK_FILE = '.lock'
+
+
+def read_journal(path):
+    # Returns (records, bytes of complete records); a record torn by a crash is dropped
+    records = []
+    offset = 0
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return records, 0
+
+    while offset < len(data):
+        record_format = RECORD_FORMATS.get(data[offset])
+        if record_format is None or offset + record_format.size > len(data):
+            break
+        fields = record_format.unpack_from(data, offset)
+        if fields[0] == PREDICTION:
+            _, char, hour, predicted, method, state, confidence = fields
+            records.append(PredictionRecord('prediction', char.decode('ascii'), hour, predicted.decode('ascii'),
+                                            METHODS[method], STATES[state], confidence))
+        else:
+            weights = {name: value for name, value in zip(WEIGHTS, fields[2:]) if value == value}
+            records.append(ReanalysisRecord('reanalysis', bool(fields[1]), weights or None))
+        offset += record_format.size
+    return records, offset
+
+
+def write_atomic(path, dump):
+    staging = f'{path}.tmp'
+    with open(staging, 'wb') as f:
+        dump(f)
+    os.replace(staging, path)
+
+
+class SessionJournal:
+    # Journal of one predictor. Hooks are called by the predictor on its update
+    # queue, so records are written in the order the updates happened. Records
+    # are flushed to the OS one by one, which survives a process crash.
+
+    def __init__(self, store, session_id, path, serial, model_generation):
+        self.store = store
+        self.session_id = session_id
+        self.path = path
+        self.serial = serial
+        self.model_generation = model_generation
+        self.records = 0
+        self.file = None
+        self.closed = False
+
+    def open(self, serial, truncate_to=None):
+        if self.file is not None:
+            self.file.close()
+        self.serial = serial
+        self.records = 0
+        journal_path = os.path.join(self.path, f'journal-{serial}.bin')
+        if truncate_to is None or not os.path.exists(journal_path):
+            self.file = open(journal_path, 'wb')
+        else:
+            self.file = open(journal_path, 'r+b')
+            # Drop a record torn by the crash before appending after it
+            self.file.truncate(truncate_to)
+            self.file.seek(truncate_to)
+
+    def append(self, data):
+        self.file.write(data)
+        self.file.flush()
+        self.records += 1
+
+    def record_prediction(self, predictor, char, prediction):
+        if self.closed:
+            return
+        try:
+            predicted, confidence, method = prediction
+            self.append(RECORD_FORMATS[PREDICTION].pack(
+                PREDICTION, char.encode('ascii'), predictor.current_hour(), predicted.encode('ascii'),
+                METHODS.index(method), STATES.index(predictor.prediction_state), confidence))
+            if self.records >= self.store.snapshot_interval:
+                self.store.write_snapshot(self, predictor)
+        except Exception as e:
+            logging.error(f"Journal write failed for session {self.session_id}: {str(e)}")
+
+    def record_reanalysis(self, predictor, result):
+        if self.closed:
+            return
+        try:
+            if predictor.model_generation != self.model_generation:
+                # New batch models cannot be replayed, so they start a new snapshot
+                self.store.write_snapshot(self, predictor)
+                return
+            weights = result['ensemble_weights'] or {}
+            self.append(RECORD_FORMATS[REANALYSIS].pack(
+                REANALYSIS, bool(result['analyze_errors']),
+                *(weights.get(name, float('nan')) for name in WEIGHTS)))
+        except Exception as e:
+            logging.error(f"Journal write failed for session {self.session_id}: {str(e)}")
+
+    def close(self):
+        self.closed = True
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SessionStore:
+    # Per-session journals and snapshots, one directory per session under root:
+    #   models-<generation>.joblib  training sequence and batch models, rewritten after a refit
+    #   snapshot-<n>.pkl            everything else the predictor updates per character
+    #   journal-<n>.bin             records of the updates made after snapshot n
+    # A snapshot is written every snapshot_interval records, after which older
+    # files are removed. Recovery loads the newest snapshot and replays its
+    # journal. Only one process may use a root at a time: the first one to
+    # attach or recover holds an exclusive lock on it, and any other process
+    # leaves the root alone.
+
+    def __init__(self, root=None, snapshot_interval=None):
+        if root is None:
+            root = os.environ.get('PREDICTOR_JOURNAL_DIR') or None
+        if snapshot_interval is None:
+            snapshot_interval = int(os.environ.get('PREDICTOR_SNAPSHOT_INTERVAL', DEFAULT_SNAPSHOT_INTERVAL))
+
+        self.root = root
+        self.snapshot_interval = max(1, snapshot_interval)
+        self.journals = {}
+        self.lock = threading.Lock()
+        self.owned = None
+        self.lock_file = None
+        if self.root:
+            os.makedirs(self.root, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return bool(self.root)
+
+    def claim(self):
+        # Whether this process owns the root, locking it on the first call
+        with self.lock:
+            if self.owned is None:
+                self.owned = self.lock_root()
+            return self.owned
+
+    def lock_root(self):
+        try:
+            import fcntl
+        except ImportError:
+            # No flock on this platform, a single process per root is assumed
+            return True
+        lock_file = open(os.path.join(self.root, LOCK_FILE), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            logging.warning(f"Session journals in {self.root} are used by another process, "
+                            f"sessions of this process are not journaled")
+            return False
+        # Held until the process exits
+        self.lock_file = lock_file
+        return True
+
+    def session_path(self, session_id):
+        return os.path.join(self.root, hashlib.sha256(session_id.encode()).hexdigest()[:32])
+
+    def attach(self, session_id, predictor):
+        # Starts a new journal for a freshly trained predictor of the session
+        if not self.enabled or not self.claim():
+            return None
+        path = self.session_path(session_id)
+        with self.lock:
+            previous = self.journals.pop(session_id, None)
+            if previous is not None:
+                previous.close()
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+            journal = SessionJournal(self, session_id, path, serial=-1, model_generation=None)
+            self.journals[session_id] = journal
+        predictor.updates.call(self.start_journal, journal, predictor)
+        return journal
+
+    def start_journal(self, journal, predictor):
+        # Runs on the predictor's update queue, so the first snapshot sees a settled state
+        self.write_snapshot(journal, predictor)
+        predictor.journal = journal
+
+    def detach(self, session_id, predictor, remove=True):
+        # Stops journaling a predictor that left the registry, by default discarding its files
+        if not self.enabled or predictor.journal is None:
+            return
+        with self.lock:
+            journal = predictor.journal
+            if self.journals.get(session_id) is not journal:
+                return
+            del self.journals[session_id]
+            journal.close()
+            if remove:
+                shutil.rmtree(journal.path, ignore_errors=True)
+
+    def write_snapshot(self, journal, predictor):
+        start = time.perf_counter()
+        models, state = predictor.session_state()
+        serial = journal.serial + 1
+
+        if predictor.model_generation != journal.model_generation:
+            import joblib
+            models_path = os.path.join(journal.path, f'models-{predictor.model_generation}.joblib')
+            write_atomic(models_path, lambda f: joblib.dump(models, f))
+            journal.model_generation = predictor.model_generation
+
+        snapshot = {
+            'session_id': journal.session_id,
+            'config': predictor.session_config(),
+            'model_generation': journal.model_generation,
+            'state': state,
+            'created': time.time()
+        }
+        write_atomic(os.path.join(journal.path, f'snapshot-{serial}.pkl'),
+                     lambda f: pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL))
+        journal.open(serial)
+        self.remove_stale(journal.path, serial, journal.model_generation)
+        logging.debug(f"Snapshot {serial} of session {journal.session_id} written in "
+                      f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def remove_stale(self, path, serial, model_generation):
+        keep = {f'snapshot-{serial}.pkl', f'journal-{serial}.bin', f'models-{model_generation}.joblib'}
+        for entry in os.scandir(path):
+            if entry.name not in keep:
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    # Still mapped by a recovered predictor on platforms that refuse to unlink it
+                    pass
+
+    def recover(self, predictor_class):
+        # Yields (session_id, predictor) for every session on disk. Children of a
+        # multiprocessing pool (e.g. PDF workers re-running app.py) never recover.
+        if not self.enabled or multiprocessing.parent_process() is not None or not self.claim():
+            return
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or not SESSION_DIR.match(entry.name):
+                continue
+            try:
+                recovered = self.load(entry.path, predictor_class)
+            except Exception as e:
+                # Kept for inspection rather than deleted, and skipped from now on
+                failed_path = f'{entry.path}.failed-{int(time.time())}'
+                logging.warning(f"Could not recover session journal {entry.name}, moved to {failed_path}: {str(e)}")
+                try:
+                    os.replace(entry.path, failed_path)
+                except OSError:
+                    pass
+                continue
+            if recovered is not None:
+                yield recovered
+
+    def load(self, path, predictor_class):
+        start = time.perf_counter()
+        serials = sorted((int(match.group(1)) for match in map(SNAPSHOT_FILE.match, os.listdir(path)) if match),
+                         reverse=True)
+        if not serials:
+            return None
+        serial = serials[0]
+        with open(os.path.join(path, f'snapshot-{serial}.pkl'), 'rb') as f:
+            snapshot = pickle.load(f)
+        import joblib
+        # Tree arrays are memory-mapped copy-on-write, as in the model cache
+        models = joblib.load(os.path.join(path, f"models-{snapshot['model_generation']}.joblib"), mmap_mode='c')
+
+        predictor = predictor_class(models['sequence'], initialize=False, **snapshot['config'])
+        predictor.restore_session(models, snapshot['state'])
+        predictor.model_generation = snapshot['model_generation']
+        records, valid_bytes = read_journal(os.path.join(path, f'journal-{serial}.bin'))
+        mismatches = predictor.replay(records)
+
+        session_id = snapshot['session_id']
+        journal = SessionJournal(self, session_id, path, serial, snapshot['model_generation'])
+        journal.open(serial, truncate_to=valid_bytes)
+        journal.records = len(records)
+        with self.lock:
+            self.journals[session_id] = journal
+        predictor.journal = journal
+        predictor.resume_background_work()
+
+        logging.info(f"Recovered session {session_id} from snapshot {serial} and {len(records)} journal records "
+                     f"in {(time.perf_counter() - start) * 1000:.1f} ms"
+                     + (f", {mismatches} replayed predictions differ" if mismatches else ""))
+        return session_id, predictor
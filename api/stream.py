@@ -0,0 +1,296 @@
+import asyncio
+import json
+import logging
+import os
+import re
+from urllib.parse import parse_qs, unquote
+
+from a2wsgi import WSGIMiddleware
+
+from services import DEFAULT_SESSION_ID, format_prediction
+import metrics
+
+
+# ASGI entry point with persistent prediction channels. Run it with
+#   uvicorn stream:application --port 5959
+# Streaming endpoints are served on the event loop, so an idle connection costs
+# a coroutine; every other route is the Flask app on a thread pool.
+
+DEFAULT_STREAM_PORT = 5959
+DEFAULT_WSGI_WORKERS = 16
+KEEPALIVE_SECONDS = 15
+# How often an idle WebSocket checks whether its session's predictor was replaced
+FOLLOW_SECONDS = 5
+SOCKET_PATH = '/ws/predict'
+EVENTS_PATH = re.compile(r'^/api/sessions/([^/]+)/events$')
+
+
+def prediction_event(prediction, last_char, state):
+    # Same message/color as /api/predict, plus the predictor state after the character
+    event = {'type': 'prediction', 'last_char': last_char}
+    event.update(format_prediction(prediction, last_char))
+    event['state'] = state
+    return event
+
+
+def error_event(error):
+    return {'type': 'error', 'error': error}
+
+
+def parse_character(text):
+    # A frame is either the bare character or {"last_char": "A"}
+    text = (text or '').strip()
+    if text.startswith('{'):
+        try:
+            text = json.loads(text).get('last_char')
+        except (ValueError, AttributeError):
+            return None
+    return text if text in ('A', 'B') else None
+
+
+def predict_for_session(registry, session_id, last_char):
+    # Runs on the executor: registry.get counts as session activity like
+    # /api/predict, and may evict idle sessions, so it stays off the event loop
+    predictor = registry.get(session_id)
+    if predictor is None:
+        return None, None
+    return predictor, predictor.predict_next(last_char)
+
+
+def session_id_from(scope):
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    if query.get('session_id'):
+        return query['session_id'][0]
+    headers = dict(scope.get('headers', []))
+    session_id = headers.get(b'x-session-id')
+    return session_id.decode('latin-1') if session_id else DEFAULT_SESSION_ID
+
+
+class SessionEvents:
+    # Follows one session's predictor and queues its events for one connection.
+    # Snapshot listeners run on the predictor's update thread, so events are
+    # handed to the event loop with call_soon_threadsafe.
+
+    def __init__(self, loop, registry, session_id, predictions=True):
+        self.loop = loop
+        self.registry = registry
+        self.session_id = session_id
+        # Whether to forward predictions made through other channels (e.g. /api/predict)
+        self.predictions = predictions
+        self.queue = asyncio.Queue()
+        self.predictor = None
+        self.state = None
+        self.prediction_count = None
+
+    def follow(self):
+        # Attach to the session's current predictor, which changes when it is retrained.
+        # Called on the event loop, so it only peeks at the registry.
+        predictor = self.registry.peek(self.session_id)
+        if predictor is not self.predictor:
+            self.detach()
+            if predictor is not None:
+                snapshot = predictor.snapshot
+                if self.state is not None and snapshot.prediction_state != self.state:
+                    # The new model starts in a different state than the one followed so far
+                    self.queue.put_nowait({'type': 'state', 'state': snapshot.prediction_state,
+                                           'previous': self.state})
+                self.state, self.prediction_count = snapshot.prediction_state, snapshot.prediction_count
+                predictor.add_listener(self.on_snapshot)
+            self.predictor = predictor
+        return predictor
+
+    def detach(self):
+        if self.predictor is not None:
+            self.predictor.remove_listener(self.on_snapshot)
+            self.predictor = None
+
+    def ready_event(self):
+        return {'type': 'ready', 'session_id': self.session_id, 'state': self.state,
+                'trained': self.predictor is not None}
+
+    def on_snapshot(self, snapshot):
+        events = []
+        if (self.predictions and snapshot.last_prediction is not None and
+                snapshot.prediction_count != self.prediction_count):
+            events.append(prediction_event(snapshot.last_prediction, snapshot.last_char,
+                                           snapshot.prediction_state))
+        if snapshot.prediction_state != self.state:
+            events.append({'type': 'state', 'state': snapshot.prediction_state, 'previous': self.state})
+        self.state, self.prediction_count = snapshot.prediction_state, snapshot.prediction_count
+        for event in events:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+
+
+async def predict_socket(scope, receive, send, registry):
+    # One WebSocket per session. Text frames carry characters; every frame is
+    # answered with a prediction or error event, and WAITING / PREDICTING
+    # transitions are pushed as state events as soon as they happen.
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    await send({'type': 'websocket.accept'})
+    metrics.STREAM_CONNECTIONS.inc(channel='websocket')
+
+    loop = asyncio.get_running_loop()
+    events = SessionEvents(loop, registry, session_id_from(scope), predictions=False)
+
+    async def forward():
+        # Single writer, so replies and pushed events never interleave
+        while True:
+            event = await events.queue.get()
+            await send({'type': 'websocket.send', 'text': json.dumps(event)})
+
+    async def next_message():
+        # Re-follows the session while the socket is idle, so a replaced or evicted
+        # predictor is let go and state events of the new one are forwarded
+        receiving = asyncio.ensure_future(receive())
+        try:
+            while not (await asyncio.wait({receiving}, timeout=FOLLOW_SECONDS))[0]:
+                events.follow()
+        finally:
+            receiving.cancel()
+        return receiving.result()
+
+    sender = asyncio.create_task(forward())
+    try:
+        events.follow()
+        events.queue.put_nowait(events.ready_event())
+        while True:
+            message = await next_message()
+            if message['type'] == 'websocket.disconnect':
+                break
+
+            text = message.get('text')
+            if text is None and message.get('bytes') is not None:
+                text = message['bytes'].decode('ascii', 'replace')
+            last_char = parse_character(text)
+            if last_char is None:
+                events.queue.put_nowait(error_event("Invalid input. Please provide 'A' or 'B'."))
+                continue
+
+            predictor = events.follow()
+            if predictor is None:
+                events.queue.put_nowait(error_event("Model has not been trained. Call /api/train first."))
+                continue
+
+            try:
+                # predict_next blocks on the session's update queue, so it runs off the loop
+                predictor, prediction = await loop.run_in_executor(
+                    None, predict_for_session, registry, events.session_id, last_char)
+            except Exception as e:
+                logging.error(f"Error during streamed prediction: {str(e)}")
+                events.queue.put_nowait(error_event(str(e)))
+                continue
+            if predictor is None:
+                # Evicted since follow() found it
+                events.queue.put_nowait(error_event("Model has not been trained. Call /api/train first."))
+                continue
+            events.queue.put_nowait(prediction_event(prediction, last_char, predictor.snapshot.prediction_state))
+    finally:
+        events.detach()
+        sender.cancel()
+        metrics.STREAM_CONNECTIONS.inc(-1, channel='websocket')
+
+
+async def send_json_response(send, status, body):
+    payload = json.dumps(body).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def session_event_stream(scope, receive, send, registry, session_id):
+    # Server-sent events for clients that cannot open a WebSocket: predictions made
+    # for the session through any channel, and its state transitions
+    loop = asyncio.get_running_loop()
+    events = SessionEvents(loop, registry, session_id, predictions=True)
+    if events.follow() is None:
+        await send_json_response(send, 404, {"error": f"Unknown session '{session_id}'"})
+        return
+
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'),
+                            (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')]})
+    metrics.STREAM_CONNECTIONS.inc(channel='sse')
+
+    async def send_event(event):
+        data = f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        await send({'type': 'http.response.body', 'body': data.encode(), 'more_body': True})
+
+    disconnected = asyncio.create_task(wait_for_disconnect(receive))
+    try:
+        await send_event(events.ready_event())
+        while not disconnected.done():
+            getter = asyncio.create_task(events.queue.get())
+            done, _ = await asyncio.wait({getter, disconnected}, timeout=KEEPALIVE_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                await send_event(getter.result())
+                continue
+
+            getter.cancel()
+            if not disconnected.done():
+                events.follow()
+                await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+    finally:
+        events.detach()
+        disconnected.cancel()
+        metrics.STREAM_CONNECTIONS.inc(-1, channel='sse')
+
+
+async def lifespan(receive, send, app_services):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Recovery and preloading may train, so they run off the loop
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, app_services.start)
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def create_asgi_app(flask_app=None, wsgi_workers=None):
+    if flask_app is None:
+        from app import app as flask_app
+    if wsgi_workers is None:
+        wsgi_workers = int(os.environ.get('STREAM_WSGI_WORKERS', DEFAULT_WSGI_WORKERS))
+    app_services = flask_app.extensions['predictor_services']
+    wsgi = WSGIMiddleware(flask_app, workers=wsgi_workers)
+
+    async def application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await lifespan(receive, send, app_services)
+        elif scope['type'] == 'websocket':
+            if scope['path'] == SOCKET_PATH:
+                await predict_socket(scope, receive, send, app_services.registry)
+            else:
+                await send({'type': 'websocket.close', 'code': 4404})
+        else:
+            match = EVENTS_PATH.match(scope['path'])
+            if match and scope['method'] == 'GET':
+                await session_event_stream(scope, receive, send, app_services.registry, unquote(match.group(1)))
+            else:
+                await wsgi(scope, receive, send)
+
+    return application
+
+
+application = create_asgi_app()
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(application, host='127.0.0.1', port=int(os.environ.get('STREAM_PORT', DEFAULT_STREAM_PORT)))
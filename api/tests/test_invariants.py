@@ -0,0 +1,134 @@
+import random
+import threading
+import time
+
+import numpy as np
+
+from EnhancedGamePredictor import EnhancedGamePredictor
+from feature_engine import BatchFeatureExtractor
+from model_cache import ModelCache
+from serial_queue import SerialQueue
+from session_journal import SessionStore
+
+
+def random_sequence(length, seed):
+    rng = random.Random(seed)
+    return ''.join(rng.choice('AB') for _ in range(length))
+
+
+def wait_idle(predictor, timeout=30):
+    deadline = time.monotonic() + timeout
+    while predictor.background_analysis_active and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert not predictor.background_analysis_active
+
+
+def test_prefix_loaded_predictor_refits_on_same_rows_as_cold_trained(tmp_path):
+    kwargs = {'online_learning': True, 'refit_interval': 50}
+    sequence = random_sequence(1500, seed=1)
+    cache = ModelCache(root=str(tmp_path), max_tail=500)
+    cache.load_or_train(EnhancedGamePredictor, sequence[:1200], **kwargs)
+
+    loaded, source = cache.load_or_train(EnhancedGamePredictor, sequence, **kwargs)
+    cold = EnhancedGamePredictor(sequence, **kwargs)
+    assert source == 'prefix'
+
+    for char in random_sequence(60, seed=2):
+        loaded.update_state(char)
+        cold.update_state(char)
+    assert loaded.chars_since_refit == cold.chars_since_refit == 60
+    assert np.array_equal(loaded.refit_sequence(*loaded.refit_inputs()).bits(),
+                          cold.refit_sequence(*cold.refit_inputs()).bits())
+
+
+def test_serial_queue_runs_calls_one_at_a_time_in_order_under_threads():
+    queue = SerialQueue()
+    ran = []
+    active = [0]
+    overlaps = []
+
+    def record(thread, i):
+        active[0] += 1
+        if active[0] > 1:
+            overlaps.append((thread, i))
+        ran.append((thread, i))
+        active[0] -= 1
+        return thread, i
+
+    def caller(thread):
+        futures = []
+        for i in range(300):
+            if i % 3 == 0:
+                futures.append(queue.submit(record, thread, i))
+            else:
+                assert queue.call(record, thread, i) == (thread, i)
+        for future in futures:
+            future.result()
+
+    threads = [threading.Thread(target=caller, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not overlaps
+    assert len(ran) == 8 * 300
+    for thread in range(8):
+        assert [i for other, i in ran if other == thread] == list(range(300))
+    assert len(queue) == 0 and not queue.running
+
+
+def test_recovered_session_predicts_like_the_live_one(tmp_path):
+    store = SessionStore(root=str(tmp_path), snapshot_interval=40)
+    live = EnhancedGamePredictor(random_sequence(1500, seed=3))
+    store.attach('session', live)
+    chars = random_sequence(150, seed=4)
+    for i, char in enumerate(chars[:100]):
+        live.predict_next(char)
+        if i % 10 == 0:
+            wait_idle(live)
+    wait_idle(live)
+
+    # The newest snapshot and the journal after it, as a crash of the live process leaves them
+    store.detach('session', live, remove=False)
+    [(session_id, recovered)] = store.recover(EnhancedGamePredictor)
+    assert session_id == 'session'
+    wait_idle(recovered)
+
+    fields = ('prediction_state', 'last_prediction', 'consecutive_errors', 'prediction_count', 'chars_seen',
+              'sequence_length', 'ensemble_weights')
+    assert [getattr(recovered.snapshot, name) for name in fields] == \
+        [getattr(live.snapshot, name) for name in fields]
+    for char in chars[100:]:
+        assert recovered.predict_next(char) == live.predict_next(char)
+        wait_idle(live)
+        wait_idle(recovered)
+    live.executor.shutdown()
+    recovered.executor.shutdown()
+
+
+def window_features(pattern, hour):
+    # The per-window features BatchFeatureExtractor replaced, computed character by character
+    def entropy(pattern):
+        freq_a = pattern.count('A') / len(pattern)
+        freq_b = 1 - freq_a
+        if freq_a == 0 or freq_b == 0:
+            return 0
+        return -(freq_a * np.log2(freq_a) + freq_b * np.log2(freq_b))
+
+    transitions = sum(1 for i in range(len(pattern) - 1) if pattern[i] != pattern[i + 1])
+    complexity = np.mean([entropy(pattern), len(set(pattern)) / len(pattern),
+                          transitions / (len(pattern) - 1) if len(pattern) > 1 else 0])
+    return ([1 if c == 'A' else 0 for c in pattern] +
+            [pattern.count('A') / len(pattern), entropy(pattern),
+             np.sin(2 * np.pi * hour / 24), np.cos(2 * np.pi * hour / 24), complexity])
+
+
+def test_batch_features_match_per_window_features():
+    window, hour = 10, 7
+    sequence = random_sequence(400, seed=5) + 'A' * 30 + 'B' * 30 + 'AB' * 20
+    X, y = BatchFeatureExtractor(window).training_data(sequence, hour)
+
+    expected = [window_features(sequence[i:i + window], hour) for i in range(len(sequence) - window)]
+    assert np.array_equal(X, np.array(expected))
+    assert np.array_equal(y, [1 if c == 'A' else 0 for c in sequence[window:]])
@@ -0,0 +1,137 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_TRAINING_WORKERS = 2
+DEFAULT_JOB_RETENTION = 1000
+
+
+class TrainingJob:
+    def __init__(self, session_id, sequence_length, expected_phases):
+        self.job_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.sequence_length = sequence_length
+        self.expected_phases = expected_phases
+        self.status = 'queued'
+        self.phase = None
+        self.phase_timings = {}
+        self.source = None
+        self.error = None
+        # Extra results of the job's inputs, e.g. the files an ingestion parsed
+        self.details = {}
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in ('succeeded', 'failed', 'superseded')
+
+    def record_phase(self, phase, seconds):
+        self.phase_timings[phase] = round(seconds, 6)
+        self.phase = phase
+
+    def progress(self):
+        if self.finished:
+            return 1.0
+        completed = sum(1 for phase in self.expected_phases if phase in self.phase_timings)
+        return round(completed / len(self.expected_phases), 3) if self.expected_phases else 0.0
+
+    def to_dict(self):
+        now = time.time()
+        return {
+            'job_id': self.job_id,
+            'session_id': self.session_id,
+            'status': self.status,
+            'phase': self.phase,
+            'progress': self.progress(),
+            'phase_timings': dict(self.phase_timings),
+            'source': self.source,
+            'error': self.error,
+            'sequence_length': self.sequence_length,
+            'details': dict(self.details),
+            'queued_seconds': round((self.started_at or now) - self.submitted_at, 6),
+            'elapsed_seconds': round((self.finished_at or now) - (self.started_at or now), 6)
+        }
+
+
+class TrainingJobManager:
+    # Runs training in background threads. A finished model is handed to
+    # on_ready (which swaps it into the registry) only if no newer job has been
+    # submitted for the same session in the meantime. Publishing can take a
+    # while (journal snapshot, memory measurement), so it runs under a lock of
+    # its session rather than the manager lock that polls and submits take.
+
+    def __init__(self, max_workers=None, retention=DEFAULT_JOB_RETENTION, on_finished=None):
+        if max_workers is None:
+            max_workers = int(os.environ.get('TRAINING_WORKERS', DEFAULT_TRAINING_WORKERS))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='train')
+        self.retention = retention
+        # Called with each job once it reaches a final state
+        self.on_finished = on_finished
+        self.jobs = OrderedDict()
+        self.latest_for_session = {}
+        self.publish_locks = {}
+        self.lock = threading.Lock()
+
+    def submit(self, session_id, sequence_length, train_fn, on_ready, expected_phases=()):
+        # train_fn(job) returns (predictor, source); on_ready(session_id, predictor) publishes it
+        job = TrainingJob(session_id, sequence_length, tuple(expected_phases))
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self.latest_for_session[session_id] = job.job_id
+            self.prune()
+        self.executor.submit(self.run, job, train_fn, on_ready)
+        return job
+
+    def run(self, job, train_fn, on_ready):
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            predictor, job.source = train_fn(job)
+            with self.lock:
+                superseded = self.latest_for_session.get(job.session_id) != job.job_id
+                if not superseded:
+                    publish_lock = self.publish_locks.setdefault(job.session_id, threading.Lock())
+            if not superseded:
+                # A newer job of the session that finishes meanwhile waits here, so it publishes after this one
+                with publish_lock:
+                    with self.lock:
+                        superseded = self.latest_for_session.get(job.session_id) != job.job_id
+                    if not superseded:
+                        on_ready(job.session_id, predictor)
+            job.status = 'superseded' if superseded else 'succeeded'
+        except Exception as e:
+            logging.error(f"Training job {job.job_id} failed: {str(e)}")
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+            job.done.set()
+            if self.on_finished is not None:
+                self.on_finished(job)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def prune(self):
+        # Drop the oldest finished jobs beyond the retention limit, and the
+        # bookkeeping of sessions whose latest job is dropped
+        excess = len(self.jobs) - self.retention
+        for job_id in list(self.jobs):
+            if excess <= 0:
+                break
+            job = self.jobs[job_id]
+            if job.finished:
+                del self.jobs[job_id]
+                excess -= 1
+                if self.latest_for_session.get(job.session_id) == job_id:
+                    del self.latest_for_session[job.session_id]
+                    self.publish_locks.pop(job.session_id, None)
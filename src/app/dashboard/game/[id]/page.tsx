@@ -17,11 +17,13 @@ const GamePage = ({ params }: { params: Promise<{ id: string }> }) => {
   const [output, setOutput] = useState("");
   const [outputColor, setOutputColor] = useState("");
   const [sequence, setSequence] = useState<string[]>([]);
-  const [pdfFile, setPdfFile] = useState<File | null>(null);
+  const [pdfFiles, setPdfFiles] = useState<File[]>([]);
   const [isTraining, setIsTraining] = useState(false);
   const [isProcessing, setIsProcessing] = useState(false);
   const [isPredicting, setIsPredicting] = useState(false);
   const [selectedValue, setSelectedValue] = useState("");
+  // Each tab trains and predicts on its own model on the server
+  const [sessionId, setSessionId] = useState("");
 
   const { toast } = useToast();
 
@@ -31,6 +33,15 @@ const GamePage = ({ params }: { params: Promise<{ id: string }> }) => {
       const gameId = Number(resolvedParams.id);
       const foundGame = Games.find((item) => item.gameId === gameId);
       setGame(foundGame || null);
+
+      // Kept in sessionStorage so a reload of the tab finds its model again
+      const storageKey = `predictor-session-${gameId}`;
+      let id = sessionStorage.getItem(storageKey);
+      if (!id) {
+        id = `game-${gameId}-${crypto.randomUUID()}`;
+        sessionStorage.setItem(storageKey, id);
+      }
+      setSessionId(id);
     };
 
     fetchGame();
@@ -56,6 +67,7 @@ const GamePage = ({ params }: { params: Promise<{ id: string }> }) => {
         headers: {
           "Content-Type": "application/json",
           "Access-Control-Allow-Origin": "*",
+          "X-Session-Id": sessionId,
         },
         body: JSON.stringify({ last_char: selectedValue.toUpperCase() }),
       });
@@ -103,6 +115,24 @@ const GamePage = ({ params }: { params: Promise<{ id: string }> }) => {
       .join("");
   };
 
+  const waitForTrainingJob = async (jobId: string) => {
+    while (true) {
+      const response = await fetch(
+        `http://127.0.0.1:5959/api/train/${jobId}`
+      );
+      const job = await response.json();
+
+      if (!response.ok || job.status === "failed") {
+        throw new Error(job.error || "Training failed");
+      }
+      if (job.status === "succeeded" || job.status === "superseded") {
+        return job;
+      }
+
+      await new Promise((resolve) => setTimeout(resolve, 500));
+    }
+  };
+
   const handleTrain = async (textToTrain: string) => {
     setIsTraining(true);
 
@@ -120,6 +150,7 @@ const GamePage = ({ params }: { params: Promise<{ id: string }> }) => {
         headers: {
           "Content-Type": "application/json",
           "Access-Control-Allow-Origin": "*",
+          "X-Session-Id": sessionId,
         },
         body: JSON.stringify({ sequence: processedSequence }),
       });
@@ -132,6 +163,11 @@ const GamePage = ({ params }: { params: Promise<{ id: string }> }) => {
       const data = await response.json();
       console.log("Train response:", data);
 
+      // Training runs in the background; poll the job until it finishes
+      if (data.job_id) {
+        await waitForTrainingJob(data.job_id);
+      }
+
       toast({
         title: "Connected successfully!",
         description: "You can use software for prediction",
@@ -156,14 +192,12 @@ const GamePage = ({ params }: { params: Promise<{ id: string }> }) => {
   };
 
   const handleFileChange = (event: React.ChangeEvent<HTMLInputElement>) => {
-    const file = event.target.files?.[0];
-    if (file) {
-      setPdfFile(file);
-    }
+    // Files are ingested in the order they were selected
+    setPdfFiles(Array.from(event.target.files ?? []));
   };
 
   const handleExtractText = async () => {
-    if (!pdfFile) {
+    if (pdfFiles.length === 0) {
       toast({
         title: "No file selected!",
         description: "Please upload a PDF file first.",
@@ -173,36 +207,37 @@ const GamePage = ({ params }: { params: Promise<{ id: string }> }) => {
     }
     setIsProcessing(true); // Start processing
 
+    // The server extracts, reverses and trains on the PDFs in one job,
+    // so the sequence never has to be sent back and forth
     const formData = new FormData();
-    formData.append("file", pdfFile);
+    pdfFiles.forEach((file) => formData.append("file", file));
 
     try {
-      const response = await fetch("http://127.0.0.1:5959/extract_text", {
+      const response = await fetch("http://127.0.0.1:5959/api/ingest", {
         method: "POST",
         headers: {
           "Access-Control-Allow-Origin": "*", // Add this if your backend supports it
+          "X-Session-Id": sessionId,
         },
         body: formData,
       });
 
+      const data = await response.json();
       if (!response.ok) {
-        throw new Error("Failed to extract text");
+        throw new Error(data.error || "Failed to extract text");
       }
 
-      const data = await response.json();
-      const extractedText = data.text;
-
-      // Process the extracted text
-      const processedText = processTextForTraining(extractedText);
-
-      if (!processedText) {
-        throw new Error("No valid sequence found in the extracted text");
-      }
+      const job = await waitForTrainingJob(data.job_id);
+      const tail: string = job.details?.tail ?? "";
+      setMessage(tail);
 
-      setMessage(processedText);
+      toast({
+        title: "Connected successfully!",
+        description: "You can use software for prediction",
+      });
 
-      // Train with the processed text
-      await handleTrain(processedText);
+      // Update sequence with last 10 valid characters
+      setSequence(tail.split("").reverse());
     } catch (error) {
       console.error("Error extracting text:", error);
       toast({
@@ -334,12 +369,13 @@ const GamePage = ({ params }: { params: Promise<{ id: string }> }) => {
             <Input
               type="file"
               accept=".pdf"
+              multiple
               onChange={handleFileChange}
               className="p-2 border rounded-md w-full sm:w-auto"
             />
             <Button
               onClick={handleExtractText}
-              disabled={isProcessing || !pdfFile}
+              disabled={isProcessing || pdfFiles.length === 0}
               className="w-full sm:w-auto px-6 py-2 transition-colors duration-200"
             >
               {isProcessing ? (